@@ -1,11 +1,16 @@
 import numpy as np
 
+from src.utilities.memory_maker import MemoryStack, memorize_sequence
+
 
 # axis=2 for frames, axis=0 for telems
 def memory_creator(instance, memory_list, length=4, interval=2, axis=2):
     if instance is None:
         return None
 
+    if isinstance(memory_list, MemoryStack):
+        return memory_list.append(instance)
+
     memory_list.append(instance)
     near_memory = memory_list[::-interval]
 
@@ -19,28 +24,62 @@ def memory_creator(instance, memory_list, length=4, interval=2, axis=2):
 
 
 def read_stored_data_with_labels(reader, transformer, filename, numeric_columns, label_columns):
-    telemetry = reader.read_specific_telemetry_columns(filename + '.csv', numeric_columns)
-    diffs = reader.read_specific_telemetry_columns(filename + '.csv', label_columns)
+    telemetry, diffs = reader.read_telemetry_column_sets(filename, numeric_columns, label_columns)
     frames = reader.read_video(filename + '.avi')
     resized_frames = transformer.resize_and_normalize_video(frames)
 
-    return resized_frames, telemetry.to_numpy(), diffs.to_numpy()
+    return resized_frames, telemetry, diffs
 
 
 def read_stored_data_with_shifted_labels(reader, frame_transformation, filename, numeric_columns, label_columns):
-    telemetry = reader.read_specific_telemetry_columns(filename + '.csv', numeric_columns)
-    telemetry.drop(telemetry.tail(1).index, inplace=True)
-
-    diffs = reader.read_specific_telemetry_columns(filename + '.csv', label_columns)
-    diffs.drop(diffs.head(1).index, inplace=True)
+    telemetry, diffs = read_shifted_numerics_and_targets(reader, filename, numeric_columns, label_columns)
 
     frames = reader.read_video(filename + '.avi')
     resized_frames = frame_transformation(frames)
 
-    return resized_frames, telemetry.to_numpy(), diffs.to_numpy()
+    return resized_frames, telemetry, diffs
+
+
+def iter_stored_data_with_shifted_labels(reader, transformer, filename, numeric_columns, label_columns, chunk_size=256):
+    """
+    Chunked read_stored_data_with_shifted_labels for laps that do not fit in memory.
+    Yields (frames, telemetry, diffs) of up to chunk_size rows, the frame buffer is reused between chunks.
+    """
+    telemetry, diffs = read_shifted_numerics_and_targets(reader, filename, numeric_columns, label_columns)
+
+    resized_frames = None
+    for offset, frames in reader.read_video_chunks(filename + '.avi', chunk_size=chunk_size, stop=diffs.shape[0]):
+        if resized_frames is None:
+            resized_frames = np.empty((chunk_size, transformer.resolution[1], *frames.shape[2:]), dtype=transformer.frame_dtype)
+
+        count = frames.shape[0]
+        transformer.cut_wide_and_normalize_into(frames, resized_frames)
+        yield resized_frames[:count], telemetry[offset:offset + count], diffs[offset:offset + count]
 
 
 def create_memorized_dataset(frames, telemetry, diffs, length, interval):
+    # final length diff is (length - 1) * interval
+    len_diff = (length - 1) * interval
+
+    mem_frames = memorize_sequence(frames, length, interval)
+    mem_telems = memorize_sequence(telemetry, length, interval)
+    mem_diffs = diffs[len_diff:]
+
+    assert mem_frames.shape[0] == mem_telems.shape[0] == mem_diffs.shape[0], "Lengths differ!"
+    return mem_frames, mem_telems, mem_diffs
+
+
+def create_memorized_datasets(frames, telemetry, diffs, memory_variants):
+    """Builds every (length, interval) variant from the same decoded frames, keyed by memory string."""
+    datasets = {}
+    for length, interval in memory_variants:
+        datasets['n{}_m{}'.format(length, interval)] = create_memorized_dataset(frames, telemetry, diffs, length, interval)
+
+    return datasets
+
+
+def create_memorized_dataset_iterative(frames, telemetry, diffs, length, interval):
+    """Reference implementation of create_memorized_dataset, one memory_creator call per row."""
     # final length diff is (length - 1) * interval
     mem_slice_frames = []
     mem_slice_telemetry = []
@@ -63,13 +102,16 @@ def create_memorized_dataset(frames, telemetry, diffs, length, interval):
     return mem_frames, mem_telems, mem_diffs
 
 
-def read_shifted_numerics_and_targets(reader, filename, numeric_columns, label_columns):
-    telemetry = reader.read_specific_telemetry_columns(filename + '.csv', numeric_columns)
-    telemetry.drop(telemetry.tail(1).index, inplace=True)
+def verify_memorized_dataset(frames, telemetry, diffs, length, interval):
+    """Checks the vectorized memorization against the iterative reference."""
+    expected = create_memorized_dataset_iterative(frames, telemetry, diffs, length, interval)
+    actual = create_memorized_dataset(frames, telemetry, diffs, length, interval)
 
-    diffs = reader.read_specific_telemetry_columns(filename + '.csv', label_columns)
-    diffs.drop(diffs.head(1).index, inplace=True)
+    return all(np.array_equal(e, a) for e, a in zip(expected, actual))
 
-    return telemetry.to_numpy(), diffs.to_numpy()
+
+def read_shifted_numerics_and_targets(reader, filename, numeric_columns, label_columns):
+    telemetry, diffs = reader.read_telemetry_column_sets(filename, numeric_columns, label_columns)
+    return telemetry[:-1], diffs[1:]
 
 
@@ -0,0 +1,42 @@
+import time
+import numpy as np
+
+
+class ConfigOverride:
+    """Reads through to a loaded configuration, with the given attributes replaced."""
+    def __init__(self, config, **overrides):
+        self.config = config
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['config'], name)
+
+
+def time_calls(function, iterations, warmup=10):
+    """Calls function repeatedly, returns per-call durations in milliseconds."""
+    for _ in range(warmup):
+        function()
+
+    durations = np.zeros(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        function()
+        durations[i] = time.perf_counter() - start
+
+    return durations * 1000.0
+
+
+def latency_summary(durations_ms):
+    return {
+        'count': len(durations_ms),
+        'mean': float(np.mean(durations_ms)),
+        'p50': float(np.percentile(durations_ms, 50)),
+        'p90': float(np.percentile(durations_ms, 90)),
+        'p99': float(np.percentile(durations_ms, 99)),
+        'max': float(np.max(durations_ms))
+    }
+
+
+def format_summary(name, summary, unit='ms'):
+    return '{:<28} n={:<6} mean={:.3f}{unit} p50={:.3f}{unit} p90={:.3f}{unit} p99={:.3f}{unit} max={:.3f}{unit}'.format(
+        name, summary['count'], summary['mean'], summary['p50'], summary['p90'], summary['p99'], summary['max'], unit=unit)
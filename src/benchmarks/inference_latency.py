@@ -0,0 +1,31 @@
+import argparse
+import numpy as np
+
+from commons.configuration_manager import ConfigurationManager
+
+from src.learning.model_wrapper import ModelWrapper
+from src.benchmarks.benchmark_commons import time_calls, latency_summary, format_summary
+
+
+def benchmark_predict(conf, fast_inference, iterations):
+    model = ModelWrapper(conf, output_shape=2, fast_inference=fast_inference)
+
+    mem_frame = np.random.random((conf.frame_height, conf.frame_width, 3 * conf.m_length)).astype(np.float32)
+    mem_telemetry = np.random.random((4 * conf.m_length,))
+
+    return latency_summary(time_calls(lambda: model.predict(mem_frame, mem_telemetry), iterations))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-tick ModelWrapper.predict latency, Keras predict vs traced forward pass.')
+    parser.add_argument('--iterations', type=int, default=500)
+    args = parser.parse_args()
+
+    conf = ConfigurationManager().config
+
+    before = benchmark_predict(conf, False, args.iterations)
+    after = benchmark_predict(conf, True, args.iterations)
+
+    print(format_summary('keras predict', before))
+    print(format_summary('fast inference', after))
+    print('p50 speedup: {:.1f}x'.format(before['p50'] / after['p50']))
@@ -0,0 +1,90 @@
+import os
+import json
+import argparse
+import numpy as np
+
+from commons.configuration_manager import ConfigurationManager
+
+from src.benchmarks.benchmark_commons import ConfigOverride, time_calls, latency_summary, format_summary
+from src.learning.export import QUANTIZATIONS, tflite_path, input_specs, representative_dataset, export_tflite
+from src.learning.model_wrapper import ModelWrapper
+from src.learning.training.generator import Generator
+
+
+def export_missing(conf, model_name, quantizations, memory, samples):
+    """Exports the quantized variants that do not exist yet, returns their file names."""
+    model = None
+    names = []
+    for quantization in quantizations:
+        export_file = tflite_path(conf.path_to_models, model_name, quantization)
+        names.append(os.path.basename(export_file))
+        if os.path.isfile(export_file):
+            continue
+
+        if model is None:
+            from tensorflow.keras.models import load_model
+            model = load_model(conf.path_to_models + model_name)
+
+        representative_data = None
+        if quantization == 'int8':
+            specs = input_specs(model)
+            generator = Generator(conf, memory_tuple=memory, base_path=conf.path_to_training, column_mode='steer', frame_dtype=specs[0][1])
+            representative_data = representative_dataset(generator, specs, samples)
+        export_tflite(model, export_file, quantization, representative_data)
+        print("Exported {}".format(export_file))
+
+    return names
+
+
+def benchmark_model(conf, model_name, memory, iterations):
+    model = ModelWrapper(conf, output_shape=2, memory_tuple=memory, model_name=model_name)
+
+    # every validation sample, the eval generator's own split does not matter here
+    generator = Generator(conf, memory_tuple=memory, eval_mode=True, batch_size=32, column_mode='steer', frame_dtype=model.frame_dtype)
+    indexes = np.sort(np.concatenate((generator.train_indexes, generator.test_indexes)))
+    output_errors = model.output_mean_squared_errors(generator, indexes)
+
+    mem_frame = np.random.random((conf.frame_height, conf.frame_width, 3 * memory[0])).astype(np.float32)
+    mem_telemetry = np.random.random((4 * memory[0],))
+    latencies = time_calls(lambda: model.predict(mem_frame, mem_telemetry), iterations)
+
+    return {
+        'size_mb': os.path.getsize(conf.path_to_models + model_name) / 2 ** 20,
+        'samples': len(indexes),
+        'mse': float(np.mean(output_errors)),
+        'output_mse': output_errors.tolist(),
+        'latency_ms': latency_summary(latencies)
+    }
+
+
+def print_report(reports, baseline):
+    base = reports[baseline]
+    for name, report in reports.items():
+        print('{}: {:.1f} MB, validation MSE {:.6f} ({:+.2f}% vs keras) per output {}, p50 speedup {:.2f}x'.format(
+            name, report['size_mb'], report['mse'], 100.0 * (report['mse'] - base['mse']) / base['mse'],
+            ['{:.6f}'.format(error) for error in report['output_mse']], base['latency_ms']['p50'] / report['latency_ms']['p50']))
+        print(format_summary('  predict latency', report['latency_ms']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Validation accuracy versus single-prediction latency of quantized TFLite exports '
+                                                 'against the Keras model they come from.')
+    parser.add_argument('model', help='Keras model file name in path_to_models, e.g. model_n1_m1_17.h5')
+    parser.add_argument('--quantizations', nargs='+', default=['int8', 'float16'], choices=QUANTIZATIONS)
+    parser.add_argument('--memory', default=None, help='length,interval of the model, config m_length,m_interval by default')
+    parser.add_argument('--representative-samples', type=int, default=200)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--output', default=None, help='JSON file for the reports')
+    args = parser.parse_args()
+
+    config = ConfigurationManager().config
+    conf = ConfigOverride(config, model_start_mode='regular', serving_artifacts=False, print_model_summary=False, fast_inference=True)
+    memory = tuple(int(value) for value in args.memory.split(',')) if args.memory else (conf.m_length, conf.m_interval)
+
+    variants = [args.model] + export_missing(conf, args.model, args.quantizations, memory, args.representative_samples)
+    reports = {name: benchmark_model(conf, name, memory, args.iterations) for name in variants}
+    print_report(reports, args.model)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=2)
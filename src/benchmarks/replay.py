@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import signal
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import zmq
+import zmq.asyncio
+
+from src.benchmarks.benchmark_commons import ConfigOverride, latency_summary, format_summary
+from src.learning.training.training_file_reader import TrainingFileReader
+from src.utilities.frame_transport import send_frame_message
+from src.utilities.telemetry_store import has_telemetry, load_telemetry
+
+EXPERT_COLUMNS = ('d_gear', 'd_steering', 'd_throttle', 'd_braking', 'manual_override')
+SEQUENCE_KEY = 'replay_seq'
+
+
+def load_lap(lap_path, frame_limit=None):
+    """Frames and (telemetry, expert action) messages of a recorded lap, as the car would send them."""
+    reader = TrainingFileReader(path_to_training=os.path.dirname(lap_path) + '/')
+    name = os.path.basename(lap_path)
+
+    if has_telemetry(lap_path):
+        table = load_telemetry(lap_path, mmap=False)
+        rows = [{column: row[column].item() for column in table.dtype.names} for row in table]
+    else:
+        rows = json.loads(reader.read_telemetry_as_csv(name + '.csv').drop(columns='Unnamed: 0', errors='ignore').to_json(orient='records'))
+
+    frames = []
+    for frame in reader.iter_video(name + '.avi', stop=frame_limit):
+        frames.append(frame)
+
+    messages = []
+    for i, row in enumerate(rows[:len(frames)]):
+        telemetry = {key: value for key, value in row.items() if key not in EXPERT_COLUMNS}
+        expert_action = {key: row[key] for key in EXPERT_COLUMNS if key in row}
+        expert_action['manual_override'] = bool(expert_action.get('manual_override', False))
+        # echoed back whenever the loop answers with the expert action, which makes the response order checkable
+        expert_action[SEQUENCE_KEY] = i
+        messages.append([telemetry, expert_action])
+
+    return frames[:len(messages)], messages
+
+
+def run_control_loop(overrides, use_gpu):
+    if not use_gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s control loop: %(message)s')
+
+    from commons.configuration_manager import ConfigurationManager
+    from src.main import main_dagger, cancel_tasks
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGINT, cancel_tasks, loop)
+    loop.add_signal_handler(signal.SIGTERM, cancel_tasks, loop)
+
+    context = zmq.asyncio.Context()
+    try:
+        loop.run_until_complete(main_dagger(context, ConfigOverride(ConfigurationManager().config, **overrides)))
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.close()
+        context.destroy()
+
+
+async def replay(context, frames, messages, data_port, controls_port, fps, timeout, settle):
+    # XPUB reports the control loop's subscription, so no frame is sent before it can be received
+    data_queue = context.socket(zmq.XPUB)
+    data_queue.bind('tcp://*:{}'.format(data_port))
+    controls_queue = context.socket(zmq.SUB)
+    controls_queue.connect('tcp://localhost:{}'.format(controls_port))
+    controls_queue.setsockopt_string(zmq.SUBSCRIBE, '')
+
+    try:
+        await asyncio.wait_for(data_queue.recv(), timeout)
+        await asyncio.sleep(settle)
+
+        count = len(frames)
+        send_times = np.zeros(count)
+        receive_times = np.full(count, np.nan)
+        responses = []
+        in_flight = asyncio.Semaphore(1 if fps <= 0 else count)
+
+        async def send_frames():
+            start = time.perf_counter()
+            for i in range(count):
+                await in_flight.acquire()
+                if fps > 0:
+                    await asyncio.sleep(max(0.0, start + i / fps - time.perf_counter()))
+                send_times[i] = time.perf_counter()
+                await send_frame_message(data_queue, frames[i], messages[i])
+
+        sender = asyncio.ensure_future(send_frames())
+        try:
+            while len(responses) < count:
+                controls = await asyncio.wait_for(controls_queue.recv_json(), timeout)
+                receive_times[len(responses)] = time.perf_counter()
+                responses.append(controls)
+                in_flight.release()
+        except asyncio.TimeoutError:
+            logging.warning("No response in {}s, received {} of {}".format(timeout, len(responses), count))
+        finally:
+            sender.cancel()
+
+        return send_times, receive_times, responses
+    finally:
+        data_queue.close(linger=0)
+        controls_queue.close(linger=0)
+
+
+def replay_report(send_times, receive_times, responses):
+    received = len(responses)
+    latencies = (receive_times[:received] - send_times[:received]) * 1000.0
+
+    # responses carry the sequence number of the frame they answer only when they echo its expert action,
+    # model controls do not, without any echo the order is unchecked rather than correct
+    echoed = sum(1 for controls in responses if SEQUENCE_KEY in controls)
+    out_of_order = None
+    if echoed > 0:
+        out_of_order = sum(1 for i, controls in enumerate(responses) if SEQUENCE_KEY in controls and controls[SEQUENCE_KEY] != i)
+
+    duration = receive_times[received - 1] - send_times[0] if received > 0 else 0.0
+    return {
+        'sent': len(send_times),
+        'received': received,
+        'missing': len(send_times) - received,
+        'echoed': echoed,
+        'out_of_order': out_of_order,
+        'fps': received / duration if duration > 0 else 0.0,
+        'latency_ms': latency_summary(latencies) if received > 0 else None
+    }
+
+
+def benchmark_mode(control_mode, frames, messages, args, work_path):
+    conf_overrides = {
+        'control_mode': control_mode,
+        'dagger_training_enabled': False,
+        'ingestion_mode': args.ingestion_mode,
+        'data_queue_port': args.data_port,
+        'controls_queue_port': args.controls_port,
+        'path_to_training': work_path,
+        'path_to_session_files': work_path + 'session/',
+        'path_to_dagger_models': work_path + 'dagger/',
+        'latency_export_interval': 0,
+        'latency_export_path': work_path + 'latency_{}.json'.format(control_mode)
+    }
+    for folder in (conf_overrides['path_to_session_files'], conf_overrides['path_to_dagger_models']):
+        os.makedirs(folder, exist_ok=True)
+
+    context = zmq.asyncio.Context()
+    process = multiprocessing.get_context('spawn').Process(target=run_control_loop, args=(conf_overrides, args.gpu))
+    try:
+        process.start()
+        results = asyncio.get_event_loop().run_until_complete(
+            replay(context, frames, messages, args.data_port, args.controls_port, args.fps, args.timeout, args.settle))
+    finally:
+        if process.is_alive():
+            # SIGINT lets main_dagger run its cleanup, which also exports its stage latencies
+            os.kill(process.pid, signal.SIGINT)
+        process.join(args.timeout)
+        if process.is_alive():
+            process.terminate()
+        context.destroy(linger=0)
+
+    report = replay_report(*results)
+    if os.path.isfile(conf_overrides['latency_export_path']):
+        with open(conf_overrides['latency_export_path']) as latency_file:
+            report['loop_stages_us'] = json.load(latency_file)['stages_us']
+
+    return report
+
+
+def print_report(control_mode, report):
+    if report['out_of_order'] is None:
+        order = 'order unchecked, model controls do not echo {}'.format(SEQUENCE_KEY)
+    elif report['echoed'] < report['received']:
+        order = 'out of order {out_of_order} of {echoed} checked, the other responses are model controls'.format(**report)
+    else:
+        order = 'out of order {out_of_order} of {echoed} checked'.format(**report)
+    print('{}: sent {sent}, received {received}, missing {missing}, {order}, {fps:.1f} fps'.format(control_mode, order=order, **report))
+    if report['latency_ms'] is not None:
+        print(format_summary('  tick latency', report['latency_ms']))
+    for stage, summary in report.get('loop_stages_us', {}).items():
+        print(format_summary('  loop ' + stage, summary, unit='us'))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description='Replays a recorded lap through main_dagger over local ZMQ sockets and reports '
+                                                 'throughput, tick latency and response order per control mode. '
+                                                 'Order is only checked on expert action responses, so not in full_model mode.')
+    parser.add_argument('lap', help='recorded lap path without extension, e.g. ../training/laps/2020_02_27_i1')
+    parser.add_argument('--modes', nargs='+', default=['full_model', 'full_expert', 'shared'])
+    parser.add_argument('--frames', type=int, default=None, help='replay only the first frames of the lap')
+    parser.add_argument('--fps', type=float, default=0, help='send rate, 0 sends the next frame as soon as the previous is answered')
+    parser.add_argument('--ingestion-mode', default='ordered')
+    parser.add_argument('--data-port', type=int, default=5551)
+    parser.add_argument('--controls-port', type=int, default=5552)
+    parser.add_argument('--timeout', type=float, default=60.0, help='seconds to wait for the control loop to start and to answer')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds between subscription and the first frame')
+    parser.add_argument('--gpu', action='store_true', help='let the control loop use a GPU, CPU only by default')
+    parser.add_argument('--output', default=None, help='JSON file for the reports')
+    args = parser.parse_args()
+
+    frames, messages = load_lap(args.lap, args.frames)
+    logging.info("Replaying {} frames".format(len(frames)))
+
+    reports = {}
+    work_path = tempfile.mkdtemp(prefix='replay_') + '/'
+    try:
+        for control_mode in args.modes:
+            reports[control_mode] = benchmark_mode(control_mode, frames, messages, args, work_path)
+            print_report(control_mode, reports[control_mode])
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=2)
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import queue
+import argparse
+import multiprocessing
+import numpy as np
+
+from src.benchmarks.benchmark_commons import latency_summary, format_summary
+
+PHASES = ('import', 'init', 'first_predict', 'total')
+
+
+def measure_startup(overrides, use_gpu, results):
+    """Runs in a fresh process, so every import and every TensorFlow initialization is a cold one."""
+    start = time.perf_counter()
+    if not use_gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    try:
+        from commons.configuration_manager import ConfigurationManager
+        from src.benchmarks.benchmark_commons import ConfigOverride
+        from src.learning.model_wrapper import ModelWrapper
+        imported = time.perf_counter()
+
+        conf = ConfigOverride(ConfigurationManager().config, **overrides)
+        model = ModelWrapper(conf, output_shape=2)
+        initialized = time.perf_counter()
+
+        mem_frame = np.random.random((conf.frame_height, conf.frame_width, 3 * conf.m_length)).astype(np.float32)
+        mem_telemetry = np.random.random((4 * conf.m_length,))
+        model.predict(mem_frame, mem_telemetry)
+        predicted = time.perf_counter()
+    except Exception as ex:
+        results.put({'error': str(ex)})
+        return
+
+    results.put({
+        'import': (imported - start) * 1000.0,
+        'init': (initialized - imported) * 1000.0,
+        'first_predict': (predicted - initialized) * 1000.0,
+        'total': (predicted - start) * 1000.0
+    })
+
+
+def benchmark_variant(overrides, repeats, use_gpu, timeout):
+    context = multiprocessing.get_context('spawn')
+    runs = []
+    for _ in range(repeats):
+        results = context.Queue()
+        process = context.Process(target=measure_startup, args=(overrides, use_gpu, results))
+        process.start()
+        try:
+            run = results.get(timeout=timeout)
+        except queue.Empty:
+            run = {'error': 'no result in {}s'.format(timeout)}
+        process.join(timeout)
+        if process.is_alive():
+            process.terminate()
+
+        if 'error' in run:
+            return {'error': run['error']}
+        runs.append(run)
+
+    return {phase: latency_summary(np.array([run[phase] for run in runs])) for phase in PHASES}
+
+
+def startup_variants(modes):
+    """Regular and dagger starts are measured with and without their exported serving artifact."""
+    variants = []
+    for mode in modes:
+        if mode in ('regular', 'dagger'):
+            variants.append(('{} (h5)'.format(mode), {'model_start_mode': mode, 'serving_artifacts': False, 'print_model_summary': False}))
+            variants.append(('{} (serving)'.format(mode), {'model_start_mode': mode, 'serving_artifacts': True, 'print_model_summary': False}))
+        else:
+            variants.append((mode, {'model_start_mode': mode, 'print_model_summary': False}))
+    return variants
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cold start time of ModelWrapper per model_start_mode, up to the first prediction. '
+                                                 'Serving artifacts are made with src/learning/export.py.')
+    parser.add_argument('--modes', nargs='+', default=['regular', 'dagger', 'resume', 'clean'])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--gpu', action='store_true')
+    parser.add_argument('--timeout', type=float, default=300.0, help='seconds a single start may take')
+    parser.add_argument('--output', default=None, help='JSON file for the summaries')
+    args = parser.parse_args()
+
+    reports = {}
+    for label, overrides in startup_variants(args.modes):
+        reports[label] = benchmark_variant(overrides, args.repeats, args.gpu, args.timeout)
+        if 'error' in reports[label]:
+            print('{}: failed, {}'.format(label, reports[label]['error']))
+            continue
+        for phase in PHASES:
+            print(format_summary('{} {}'.format(label, phase), reports[label][phase]))
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(reports, output_file, indent=2)
@@ -0,0 +1,35 @@
+import argparse
+import pandas as pd
+
+from src.learning.training.collector import Collector, TelemetryExtractor
+from src.benchmarks.benchmark_commons import time_calls, latency_summary, format_summary
+
+# telemetry and expert action as they arrive from the car, see example_input.txt
+TELEMETRY = {'p': 3934, 'p2': 3625, 'c': 1578851092058, 'c2': 1578851092061, 'cs': -0.00042510032653808594,
+             'cg': 0, 'ct': -139.7759072780609, 'cb': -103.98328018188477, 'b': 4836, 'sa': 372}
+EXPERT_ACTION = {'d_gear': 1, 'd_steering': 0.12, 'd_throttle': 0.5, 'd_braking': 0.0, 'manual_override': False}
+
+
+def dataframe_extraction(collector, message, columns):
+    df = pd.DataFrame.from_records([message], columns=message.keys())[message.keys()]
+    return collector.collect_df_columns(df, columns).to_numpy()[0]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-message cost of pulling numeric and diff columns from telemetry.')
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    collector = Collector()
+    numeric_extractor = TelemetryExtractor(collector.numeric_columns())
+    diff_extractor = TelemetryExtractor(collector.diff_columns())
+
+    cases = [
+        ('dataframe numeric', lambda: dataframe_extraction(collector, TELEMETRY, collector.numeric_columns())),
+        ('extractor numeric', lambda: numeric_extractor.extract(TELEMETRY)),
+        ('dataframe expert action', lambda: dataframe_extraction(collector, EXPERT_ACTION, collector.diff_columns())),
+        ('extractor expert action', lambda: diff_extractor.extract(EXPERT_ACTION)),
+    ]
+
+    for name, function in cases:
+        print(format_summary(name, latency_summary(time_calls(function, args.iterations) * 1000.0), unit='us'))
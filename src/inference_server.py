@@ -0,0 +1,180 @@
+import logging
+import traceback
+import asyncio
+import signal
+import numpy as np
+import zmq
+from zmq.asyncio import Context
+
+from commons.common_zmq import recv_array_with_json, initialize_subscriber, initialize_publisher
+from commons.configuration_manager import ConfigurationManager
+
+from src.learning.model_wrapper import ModelWrapper
+from src.utilities.transformer import Transformer
+
+
+class CarSession:
+    def __init__(self, car_id, conf, data_queue, controls_queue):
+        self.car_id = car_id
+        self.data_queue = data_queue
+        self.controls_queue = controls_queue
+
+        self.transformer = Transformer(conf)
+        self.mem_slice_frames = self.transformer.create_memory_stack()
+        self.mem_slice_numerics = self.transformer.create_memory_stack()
+
+
+class InferenceServer:
+    """
+    Serves several cars from one model. Each car has at most one request in flight, so responses stay 1:1 and in order,
+    while requests from different cars are micro-batched into a single forward pass.
+    """
+    def __init__(self, conf, model):
+        self.conf = conf
+        self.model = model
+        self.batch_size = conf.inference_batch_size
+        self.max_latency = conf.inference_max_latency_ms / 1000.0
+
+        self.__condition = asyncio.Condition()
+        self.__pending = []
+        self.__frames = None
+        self.__telemetry = None
+
+        self.batches = 0
+        self.requests = 0
+
+    async def serve_car(self, car):
+        while True:
+            frame, data = await recv_array_with_json(queue=car.data_queue)
+            telemetry, expert_action = data
+            if frame is None or telemetry is None or expert_action is None:
+                logging.info("None data from car {}".format(car.car_id))
+                continue
+
+            mem_frame = car.transformer.session_frame_wide(frame, car.mem_slice_frames)
+            mem_telemetry = car.transformer.session_numeric_input(telemetry, car.mem_slice_numerics)
+            mem_expert_action = car.transformer.session_expert_action(expert_action)
+            if mem_frame is None or mem_telemetry is None:
+                # Send back these first few instances, as the other application expects 1:1 responses
+                car.controls_queue.send_json(expert_action)
+                continue
+
+            try:
+                if self.conf.control_mode == 'full_expert' or expert_action['manual_override']:
+                    next_controls = expert_action.copy()
+                elif self.conf.control_mode == 'full_model':
+                    next_controls = (await self.__submit(mem_frame, mem_telemetry)).to_dict()
+                    next_controls['d_gear'] = mem_expert_action[0]
+                else:
+                    raise ValueError('Inference server supports full_model and full_expert control modes only!')
+
+                car.controls_queue.send_json(next_controls)
+            except Exception as ex:
+                print("Predicting exception on car {}: {}".format(car.car_id, ex))
+                traceback.print_tb(ex.__traceback__)
+                car.controls_queue.send_json(expert_action)
+
+    async def __submit(self, mem_frame, mem_telemetry):
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: len(self.__pending) < self.batch_size)
+
+            if self.__frames is None:
+                self.__frames = np.empty((self.batch_size, *mem_frame.shape), dtype=mem_frame.dtype)
+                self.__telemetry = np.empty((self.batch_size, *mem_telemetry.shape), dtype=mem_telemetry.dtype)
+
+            # memory stacks reuse their outputs, so the batch keeps its own copy
+            slot = len(self.__pending)
+            self.__frames[slot] = mem_frame
+            self.__telemetry[slot] = mem_telemetry
+
+            future = asyncio.get_event_loop().create_future()
+            self.__pending.append(future)
+            self.__condition.notify_all()
+
+        return await future
+
+    async def run_batches(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            async with self.__condition:
+                await self.__condition.wait_for(lambda: len(self.__pending) > 0)
+
+                deadline = loop.time() + self.max_latency
+                while len(self.__pending) < self.batch_size:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self.__condition.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+
+                count = len(self.__pending)
+                try:
+                    updates = self.model.predict_batch(self.__frames[:count], self.__telemetry[:count])
+                    for future, update in zip(self.__pending, updates):
+                        future.set_result(update)
+                except Exception as ex:
+                    for future in self.__pending:
+                        future.set_exception(ex)
+
+                self.batches += 1
+                self.requests += count
+                self.__pending = []
+                self.__condition.notify_all()
+
+
+async def main_inference_server(context: Context):
+    config_manager = ConfigurationManager()
+    conf = config_manager.config
+
+    assert len(conf.inference_data_ports) == len(conf.inference_controls_ports), 'Every car needs a data and a controls port!'
+
+    cars = []
+    server = None
+    try:
+        model = ModelWrapper(conf, output_shape=2)
+        server = InferenceServer(conf, model)
+
+        for car_id, (data_port, controls_port) in enumerate(zip(conf.inference_data_ports, conf.inference_controls_ports)):
+            car = CarSession(car_id, conf, context.socket(zmq.SUB), context.socket(zmq.PUB))
+            await initialize_subscriber(car.data_queue, data_port)
+            await initialize_publisher(car.controls_queue, controls_port)
+            cars.append(car)
+
+        logging.info("Serving {} cars, batch size {}".format(len(cars), server.batch_size))
+        await asyncio.gather(server.run_batches(), *[server.serve_car(car) for car in cars])
+    except Exception as ex:
+        print("Exception: {}".format(ex))
+        traceback.print_tb(ex.__traceback__)
+    finally:
+        for car in cars:
+            car.data_queue.close()
+            car.controls_queue.close()
+
+        if server is not None and server.batches > 0:
+            logging.info("Served {} requests in {} batches".format(server.requests, server.batches))
+
+
+def cancel_tasks(loop):
+    for task in asyncio.Task.all_tasks(loop):
+        task.cancel()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGINT, cancel_tasks, loop)
+    loop.add_signal_handler(signal.SIGTERM, cancel_tasks, loop)
+
+    context = zmq.asyncio.Context()
+    try:
+        loop.run_until_complete(main_inference_server(context))
+    except Exception as ex:
+        logging.error("Base interruption: {}".format(ex))
+        traceback.print_tb(ex.__traceback__)
+    finally:
+        loop.close()
+        context.destroy()
@@ -0,0 +1,92 @@
+import os
+import logging
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WeightSnapshot:
+    """
+    Weights of a model as numpy arrays, with the evaluation error they were kept for.
+    architecture is the model's JSON config, so the weights can be restored without knowing how the model was built.
+    """
+    def __init__(self, weights, error=None, iteration=0, architecture=None):
+        self.weights = weights
+        self.error = error
+        self.iteration = iteration
+        self.architecture = architecture
+
+    @classmethod
+    def of(cls, model, error=None, iteration=0):
+        # get_weights already copies the variables into new arrays, training can continue on the model
+        return cls(model.get_weights(), error, iteration, model.to_json())
+
+    def build(self):
+        """A model of the snapshot architecture with its weights, compiled as the create functions do."""
+        from tensorflow.keras.models import model_from_json
+        from src.learning.models import compile_like
+
+        return self.apply(compile_like(model_from_json(self.architecture)))
+
+    def apply(self, model):
+        model.set_weights(self.weights)
+        return model
+
+
+def save_snapshot(snapshot, file):
+    """Writes the snapshot next to the file and renames it over, a reader sees either the old or the new weights."""
+    tmp_file = file + '.tmp'
+    arrays = {'w{:03d}'.format(i): weights for i, weights in enumerate(snapshot.weights)}
+    with open(tmp_file, 'wb') as snapshot_file:
+        np.savez(snapshot_file, error=np.nan if snapshot.error is None else snapshot.error, iteration=snapshot.iteration,
+                 architecture=snapshot.architecture or '', **arrays)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_file, file)
+
+
+def load_snapshot(file):
+    with np.load(file) as data:
+        weight_keys = sorted(key for key in data.files if key.startswith('w'))
+        error = float(data['error'])
+        architecture = str(data['architecture']) if 'architecture' in data.files else ''
+        return WeightSnapshot([data[key] for key in weight_keys], None if np.isnan(error) else error, int(data['iteration']),
+                              architecture or None)
+
+
+class CheckpointWriter:
+    """
+    Writes snapshots on a background thread. A snapshot submitted while another is still waiting replaces it,
+    so a slow disk only ever delays the latest one and the caller never blocks on a write.
+    """
+    def __init__(self, file):
+        self.file = file
+
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__lock = threading.Lock()
+        self.__pending = None
+
+        self.written = 0
+        self.replaced = 0
+
+    def submit(self, snapshot):
+        with self.__lock:
+            waiting = self.__pending is not None
+            self.__pending = snapshot
+            if waiting:
+                self.replaced += 1
+                return
+        self.__executor.submit(self.__write)
+
+    def __write(self):
+        with self.__lock:
+            snapshot, self.__pending = self.__pending, None
+
+        try:
+            save_snapshot(snapshot, self.file)
+            self.written += 1
+        except Exception as ex:
+            logging.error("Checkpoint write to {} failed: {}".format(self.file, ex))
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
@@ -0,0 +1,69 @@
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DaggerTrainer:
+    """
+    Stores session batches and retrains off the control loop.
+    Every batch is stored, but at most one fit waits behind the running one, later requests are coalesced into it.
+    """
+    def __init__(self, recorder, fit_function):
+        self.__recorder = recorder
+        self.__fit_function = fit_function
+
+        self.__store_executor = ThreadPoolExecutor(max_workers=1)
+        self.__fit_executor = ThreadPoolExecutor(max_workers=1)
+        self.__lock = threading.Lock()
+        self.__fit_queued = False
+
+        self.requested = 0
+        self.coalesced = 0
+        self.completed = 0
+
+    def store(self, session_batch):
+        return self.__store_executor.submit(self.__recorder.store_batch, session_batch)
+
+    def request(self, session_batch):
+        """Stores the batch and queues a fit, returns False if the fit was coalesced into an already queued one."""
+        store_future = self.store(session_batch)
+
+        with self.__lock:
+            if self.__fit_queued:
+                self.coalesced += 1
+                return False
+            self.__fit_queued = True
+            self.requested += 1
+
+        self.__fit_executor.submit(self.__fit, store_future)
+        return True
+
+    def __fit(self, store_future):
+        try:
+            try:
+                store_future.result()
+            finally:
+                # from here on requests queue the next fit, also when storing this batch failed
+                with self.__lock:
+                    self.__fit_queued = False
+
+            self.__fit_function()
+        except Exception as ex:
+            print("Dagger training exception: {}".format(ex))
+            traceback.print_tb(ex.__traceback__)
+        finally:
+            with self.__lock:
+                self.completed += 1
+            logging.info('Dagger iter {}'.format(self.completed))
+
+    @property
+    def busy(self):
+        with self.__lock:
+            return self.completed < self.requested
+
+    def shutdown(self):
+        if self.busy:
+            logging.info("Waiting for DAgger training to finish.")
+        self.__store_executor.shutdown(wait=True)
+        self.__fit_executor.shutdown(wait=True)
@@ -0,0 +1,200 @@
+import os
+import json
+import shutil
+import argparse
+import threading
+import numpy as np
+
+SERVING_INFO = 'serving.json'
+QUANTIZATIONS = ('int8', 'float16', 'dynamic')
+
+
+def serving_path(path_to_models, model_filename):
+    return path_to_models + os.path.splitext(model_filename)[0] + '.serving/'
+
+
+def has_serving_model(export_path):
+    return os.path.isfile(export_path + SERVING_INFO)
+
+
+def source_stamp(source_file):
+    stat = os.stat(source_file)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def is_serving_model_current(export_path, source_file):
+    """False when the model file changed after the export, or the export did not record it."""
+    with open(export_path + SERVING_INFO, 'r') as info_file:
+        info = json.load(info_file)
+    return os.path.isfile(source_file) and info.get('source_stamp') == source_stamp(source_file)
+
+
+def input_specs(model):
+    """Per model input, the shape without the batch dimension and the numpy dtype."""
+    return [(tuple(model_input.shape[1:]), np.dtype(model_input.dtype.as_numpy_dtype)) for model_input in model.inputs]
+
+
+def export_serving_model(model, export_path, source_file=None):
+    """
+    Saves the batch size agnostic forward pass of a Keras model as a SavedModel.
+    Loading it restores the traced function and its variables only, there is no Keras deserialization or compilation.
+    """
+    import tensorflow as tf
+
+    specs = input_specs(model)
+    signature = [tf.TensorSpec((None, *shape), tf.as_dtype(dtype)) for shape, dtype in specs]
+
+    def call_model(*inputs):
+        return model(inputs[0] if len(inputs) == 1 else list(inputs), training=False)
+
+    module = tf.Module()
+    # the variables have to be reachable from the module to be saved with the function
+    module.weights = list(model.weights)
+    module.serve = tf.function(call_model, input_signature=signature)
+
+    tmp_path = export_path.rstrip('/') + '.tmp/'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tf.saved_model.save(module, tmp_path)
+
+    info = {
+        'inputs': [{'shape': list(shape), 'dtype': str(dtype)} for shape, dtype in specs],
+        'source': None if source_file is None else os.path.basename(source_file),
+        'source_stamp': None if source_file is None else source_stamp(source_file)
+    }
+    with open(tmp_path + SERVING_INFO, 'w') as info_file:
+        json.dump(info, info_file)
+
+    shutil.rmtree(export_path, ignore_errors=True)
+    os.replace(tmp_path, export_path)
+
+
+def load_serving_model(export_path):
+    """Returns the restored module, its serve function takes the model inputs positionally, and the input specs."""
+    import tensorflow as tf
+
+    with open(export_path + SERVING_INFO, 'r') as info_file:
+        info = json.load(info_file)
+
+    module = tf.saved_model.load(export_path)
+    specs = [(tuple(model_input['shape']), np.dtype(model_input['dtype'])) for model_input in info['inputs']]
+    return module, specs
+
+
+def tflite_path(path_to_models, model_filename, quantization):
+    return '{}{}_{}.tflite'.format(path_to_models, os.path.splitext(model_filename)[0], quantization)
+
+
+def representative_dataset(generator, specs, sample_count=200, seed=0):
+    """Calibration samples for int8 quantization, single training samples in model input order and dtype."""
+    indexes = np.random.RandomState(seed).permutation(generator.train_indexes)[:sample_count]
+
+    def samples():
+        for index in indexes:
+            frame, numeric, _ = generator.load_single_pair(index)
+            inputs = (frame, numeric)[:len(specs)]
+            yield [np.asarray(model_input, dtype=dtype).reshape((1, *shape)) for model_input, (shape, dtype) in zip(inputs, specs)]
+
+    return samples
+
+
+def export_tflite(model, export_file, quantization='int8', representative_data=None):
+    """
+    Converts a Keras model to TFLite with post-training quantization.
+    int8 quantizes weights and activations with ranges calibrated on representative_data, inputs and outputs stay float,
+    float16 halves the weights, dynamic stores int8 weights and quantizes activations on the fly.
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'int8':
+        if representative_data is None:
+            raise ValueError('int8 quantization needs representative data!')
+        converter.representative_dataset = representative_data
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization != 'dynamic':
+        raise ValueError('Misconfigured quantization!')
+
+    converted = converter.convert()
+    with open(export_file + '.tmp', 'wb') as tflite_file:
+        tflite_file.write(converted)
+    os.replace(export_file + '.tmp', export_file)
+    return len(converted)
+
+
+class TFLiteForward:
+    """
+    Callable with the same positional inputs as the traced Keras forward pass, returns the outputs as a numpy array.
+    The interpreter is resized to the batch size it is called with and is not thread-safe, calls are serialized.
+    """
+    def __init__(self, model_file, num_threads=None):
+        import tensorflow as tf
+
+        self.interpreter = tf.lite.Interpreter(model_path=model_file, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.__lock = threading.Lock()
+
+        # converter input order is not guaranteed to follow the Keras inputs, frames are the only 4D input
+        self.__inputs = sorted(self.interpreter.get_input_details(), key=lambda detail: -len(detail['shape']))
+        self.__output = self.interpreter.get_output_details()[0]
+        self.__batch_size = 1
+
+    @property
+    def specs(self):
+        return [(tuple(int(size) for size in detail['shape'][1:]), np.dtype(detail['dtype'])) for detail in self.__inputs]
+
+    def __resize(self, batch_size):
+        for detail in self.__inputs:
+            self.interpreter.resize_tensor_input(detail['index'], (batch_size, *detail['shape'][1:]))
+        self.interpreter.allocate_tensors()
+        self.__batch_size = batch_size
+
+    def __call__(self, *inputs):
+        with self.__lock:
+            batch_size = inputs[0].shape[0]
+            if batch_size != self.__batch_size:
+                self.__resize(batch_size)
+
+            for detail, model_input in zip(self.__inputs, inputs):
+                self.interpreter.set_tensor(detail['index'], np.asarray(model_input, dtype=detail['dtype']))
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.__output['index'])
+
+
+if __name__ == "__main__":
+    from tensorflow.keras.models import load_model
+    from commons.configuration_manager import ConfigurationManager
+
+    parser = argparse.ArgumentParser(description='Exports a trained model for fast startup and inference.')
+    parser.add_argument('model', help='model file name, e.g. model_n1_m1_17.h5')
+    parser.add_argument('--dagger', action='store_true', help='model is in path_to_dagger_models instead of path_to_models')
+    parser.add_argument('--format', default='serving', choices=('serving',) + QUANTIZATIONS,
+                        help='serving: SavedModel for fast startup, otherwise a quantized TFLite file')
+    parser.add_argument('--memory', default=None, help='length,interval of the model, config m_length,m_interval by default')
+    parser.add_argument('--representative-samples', type=int, default=200, help='int8 calibration samples from the training data')
+    args = parser.parse_args()
+
+    conf = ConfigurationManager().config
+    path_to_models = conf.path_to_dagger_models if args.dagger else conf.path_to_models
+    model_file = path_to_models + args.model
+    model = load_model(model_file)
+
+    if args.format == 'serving':
+        export_path = serving_path(path_to_models, args.model)
+        export_serving_model(model, export_path, source_file=model_file)
+        print("Serving model exported to {}".format(export_path))
+    else:
+        representative_data = None
+        if args.format == 'int8':
+            from src.learning.training.generator import Generator
+
+            memory = tuple(int(value) for value in args.memory.split(',')) if args.memory else (conf.m_length, conf.m_interval)
+            specs = input_specs(model)
+            generator = Generator(conf, memory_tuple=memory, base_path=conf.path_to_training, column_mode='steer', frame_dtype=specs[0][1])
+            representative_data = representative_dataset(generator, specs, args.representative_samples)
+
+        export_file = tflite_path(path_to_models, args.model, args.format)
+        size = export_tflite(model, export_file, args.format, representative_data)
+        print("{} model exported to {}, {:.1f} MB".format(args.format, export_file, size / 2 ** 20))
@@ -1,16 +1,22 @@
 import os
+import logging
 import datetime
+import functools
+import threading
 import numpy as np
-from sklearn.metrics import mean_squared_error
 from commons.car_controls import CarControlUpdates
 
-from src.learning.models import create_standalone_nvidia_cnn
+from src.learning.checkpoints import WeightSnapshot, CheckpointWriter, load_snapshot
+from src.learning.export import serving_path, has_serving_model, is_serving_model_current, load_serving_model, input_specs, \
+    TFLiteForward
+from src.learning.models import create_standalone_nvidia_cnn, clone_compiled, has_optimizer_state
 from src.learning.training.car_mapping import CarMapping
 from src.utilities.memory_maker import MemoryMaker
+from src.utilities.transformer import convert_frames
 
 
 class ModelWrapper:
-    def __init__(self, config, numeric_shape=(4,), output_shape=1, memory_tuple=None, model_num=None, model_name=None):
+    def __init__(self, config, numeric_shape=(4,), output_shape=1, memory_tuple=None, model_num=None, model_name=None, fast_inference=None):
         if memory_tuple is not None:
             memory_length, memory_interval = memory_tuple
         else:
@@ -31,33 +37,169 @@ class ModelWrapper:
         self.__frames_shape = (config.frame_height, config.frame_width, 3 * memory_length)
         self.__numeric_shape = (1 * memory_length,)
         self.__output_shape = output_shape
+        self.__uint8_frames = config.frame_dtype == 'uint8'
+
+        # best weights as a snapshot, the full min_err_model is only built when it is saved
+        self.best = None
+        self.min_error = None
+        self.output_errors = None
+        self.__min_err_model = None
+        self.__resumed = None
+        self.__evaluations = 0
+        self.__checkpoints_enabled = config.dagger_checkpoints
+        self.__checkpoint_writer = None
+        self.__session_model_name = None
+
+        self.__model = None
+        self.__model_loader = None
+        self.__model_lock = threading.Lock()
+        self.__gear_model = None
+        self.__serving = None
+        self.__input_specs = None
+        self.__forward = None
+        self.__fast_inference = config.fast_inference if fast_inference is None else fast_inference
+        self.__tflite_threads = config.tflite_threads
+        # False for inference only models, they cannot be fit or snapshotted
+        self.trainable = True
 
         # TODO split models to steering, throttle & gear models
 
         if config.model_start_mode == 'regular':
             #gear_model_name = 'gear_model_n{}_m{}_{}.h5'.format(self.memory_length, self.memory_interval, model_num)
 
-            self.model = self.__load_model(self.__path_to_models, load_model_name)
+            self.__start_from(self.__path_to_models, load_model_name, config.serving_artifacts)
             #self.gear_model = self.__load_model(gear_model_name)
             print("Loaded {}".format(load_model_name))
         elif config.model_start_mode == 'dagger':
-            self.model = self.__load_model(self.__path_to_dagger_models, load_model_name)
+            self.__start_from(self.__path_to_dagger_models, load_model_name, config.serving_artifacts)
             print("Loaded {}".format('dagger model'))
+        elif config.model_start_mode == 'resume':
+            self.model = self.__resume_latest()
         else:
             self.model = self.__create_new_model()
-            self.gear_model = self.__create_new_gear_model()
 
-        self.min_err_model = self.__create_new_model()
-        self.min_error = None
+        self.__spare_model = None
+        self.__training_model = None
 
-        self.model.summary()
+        # exported and quantized models have no Keras model to summarize until one is loaded
+        if config.print_model_summary and self.__serving is None:
+            self.model.summary()
         self.__mapping = CarMapping()
 
+        if self.__serving is None:
+            self.__input_specs = input_specs(self.model)
+            self.__forward = self.__prepare_inference(self.model)
+        self.__single_inputs = self.__create_single_inputs()
+
+    def __start_from(self, path_to_models, model_filename, use_serving_artifact):
+        """
+        Serves from the exported artifact of the model when there is one, the Keras model is then only loaded when
+        something needs it, e.g. the first DAgger fit. Without an artifact, or when the model file changed after it was
+        exported, the Keras model is loaded right away.
+        """
+        if model_filename.endswith('.tflite'):
+            self.__start_from_tflite(path_to_models + model_filename)
+            return
+
+        self.__model_loader = functools.partial(self.__load_model, path_to_models, model_filename)
+        export_path = serving_path(path_to_models, model_filename)
+
+        use_serving_artifact = use_serving_artifact and has_serving_model(export_path)
+        if use_serving_artifact and not is_serving_model_current(export_path, path_to_models + model_filename):
+            logging.warning("Serving artifact {} does not match {}, loading the model file instead. "
+                            "Export it again to start from the artifact.".format(export_path, model_filename))
+            use_serving_artifact = False
+
+        if use_serving_artifact:
+            self.__serving, self.__input_specs = load_serving_model(export_path)
+            self.__forward = self.__serving.serve
+            self.__warm_up(self.__forward)
+        else:
+            self.model = self.__model_loader()
+
+    def __start_from_tflite(self, model_file):
+        """Quantized models from src/learning/export.py are inference only, there is no Keras model to fit."""
+        if not os.path.isfile(model_file):
+            raise ValueError('Model {} not found!'.format(model_file))
+
+        forward = TFLiteForward(model_file, num_threads=self.__tflite_threads)
+        self.__serving, self.__input_specs, self.__forward = forward, forward.specs, forward
+        self.__model_loader = functools.partial(raise_inference_only, model_file)
+        self.trainable = False
+        self.__warm_up(forward)
+
+    @property
+    def model(self):
+        """Keras model of the current weights, loaded on first use when serving started from an exported artifact."""
+        if self.__model is None:
+            with self.__model_lock:
+                if self.__model is None:
+                    self.__model = self.__model_loader()
+        return self.__model
+
+    @model.setter
+    def model(self, model):
+        self.__model = model
+
+    @property
+    def gear_model(self):
+        if self.__gear_model is None:
+            self.__gear_model = self.__create_new_gear_model()
+        return self.__gear_model
+
+    def __create_single_inputs(self):
+        """Preallocated batch-of-one inputs reused by every predict call."""
+        return [np.zeros((1, *shape), dtype=dtype) for shape, dtype in self.__input_specs]
+
+    def __warm_up(self, forward):
+        forward(*[np.zeros((1, *shape), dtype=dtype) for shape, dtype in self.__input_specs])
+
+    def __prepare_inference(self, model):
+        """Traces a batch size agnostic forward pass once and warms it up, used instead of Keras predict."""
+        if not self.__fast_inference:
+            return None
+
+        import tensorflow as tf
+
+        specs = [tf.TensorSpec((None, *model_input.shape[1:]), model_input.dtype) for model_input in model.inputs]
+
+        def call_model(*inputs):
+            return model(inputs[0] if len(inputs) == 1 else list(inputs), training=False)
+
+        forward = tf.function(call_model).get_concrete_function(*specs)
+        self.__warm_up(forward)
+        return forward
+
+    @property
+    def frame_dtype(self):
+        """Frame dtype the serving model takes, uint8 models scale frames themselves."""
+        return self.__input_specs[0][1]
+
+    def __model_inputs(self, frames, numerics):
+        if frames.dtype != self.frame_dtype:
+            frames = convert_frames(frames, np.empty(frames.shape, dtype=self.frame_dtype))
+
+        if len(self.__input_specs) == 1:
+            return [frames]
+        return [frames, numerics]
+
+    def __run_model(self, inputs):
+        forward = self.__forward
+        if forward is None:
+            return self.model.predict(inputs)
+
+        outputs = forward(*inputs)
+        # TFLite returns numpy arrays already, traced functions return tensors
+        return outputs if isinstance(outputs, np.ndarray) else outputs.numpy()
+
     def __create_new_model(self):
-        return create_standalone_nvidia_cnn(activation='linear', input_shape=self.__frames_shape, output_shape=self.__output_shape)
+        """Only for clean starts, every later copy is cloned from the serving model."""
+        return create_standalone_nvidia_cnn(activation='linear', input_shape=self.__frames_shape, output_shape=self.__output_shape,
+                                            uint8_input=self.__uint8_frames)
 
     def __create_new_gear_model(self):
-        return create_standalone_nvidia_cnn(activation='softmax', input_shape=self.__frames_shape, output_shape=1)
+        return create_standalone_nvidia_cnn(activation='softmax', input_shape=self.__frames_shape, output_shape=1,
+                                            uint8_input=self.__uint8_frames)
 
     def __load_model(self, path_to_models, model_filename: str):
         from tensorflow.keras.models import load_model
@@ -67,21 +209,98 @@ class ModelWrapper:
         else:
             raise ValueError('Model {} not found!'.format(model_filename))
 
+    def __resume_latest(self):
+        """Continues from the newest dagger_num_* model, weight snapshots go into a new model without deserializing one."""
+        model_filename = find_latest_dagger_model(self.__path_to_dagger_models)
+        if model_filename is None:
+            raise ValueError('No DAgger model to resume in {}!'.format(self.__path_to_dagger_models))
+
+        if model_filename.endswith('.npz'):
+            # its error was measured in an earlier session, on other data, the first evaluation here sets min_error
+            self.best = self.__resumed = load_snapshot(self.__path_to_dagger_models + model_filename)
+            # the snapshot carries its architecture, input dtypes included, the config may describe another model
+            # it holds weights only, so the model is compiled with a new optimizer, unlike an h5 loaded with its optimizer state
+            model = self.best.build() if self.best.architecture is not None else self.best.apply(self.__create_new_model())
+        else:
+            model = self.__load_model(self.__path_to_dagger_models, model_filename)
+
+        print("Resumed {}".format(model_filename))
+        return model
+
+    @property
+    def min_err_model(self):
+        if self.best is None:
+            return None
+
+        best = self.best
+        if self.__min_err_model is None or self.__min_err_model[0] is not best:
+            model = self.__min_err_model[1] if self.__min_err_model is not None else clone_compiled(self.model)
+            self.__min_err_model = (best, best.apply(model))
+        return self.__min_err_model[1]
+
+    def __session_model(self):
+        # the name is taken once, snapshots during the session and the final model share it
+        if self.__session_model_name is None:
+            self.__session_model_name = get_model_file_name(self.__path_to_dagger_models)
+        return self.__session_model_name
+
+    def __checkpoint(self, snapshot):
+        if not self.__checkpoints_enabled:
+            return
+
+        if self.__checkpoint_writer is None:
+            self.__checkpoint_writer = CheckpointWriter(self.__path_to_dagger_models + self.__session_model() + '.npz')
+        self.__checkpoint_writer.submit(snapshot)
+
     def save_best_model(self):
-        model_filename = get_model_file_name(self.__path_to_dagger_models)
-        self.min_err_model.save(self.__path_to_dagger_models + model_filename + '.h5')
+        if self.__checkpoint_writer is not None:
+            self.__checkpoint_writer.close()
+
+        if self.best is None or self.best is self.__resumed:
+            print("No new DAgger model to save")
+            return
+
+        min_err_model = self.min_err_model
+        model_filename = self.__session_model()
+        min_err_model.save(self.__path_to_dagger_models + model_filename + '.h5')
         print("Model has been saved to {} as {}.h5".format(self.__path_to_dagger_models, model_filename))
 
     def fit(self, generator, generate_method, epochs=1, verbose=1, fresh_model=False):
+        """
+        Trains a separate training model and swaps a copy of its weights into serving when done, so predict can run meanwhile.
+        The training model is kept between fits, its optimizer state carries over from one DAgger iteration to the next.
+        """
         try:
+            # copies follow the serving model, not the config, so frame dtypes agree with the generators and predict inputs
             if fresh_model:
-                self.model = self.__create_new_model()
-
-            self.model.fit(generate_method(data='train'),
-                           steps_per_epoch=generator.train_batch_count,
-                           validation_data=generate_method(data='test'),
-                           validation_steps=generator.test_batch_count,
-                           epochs=epochs, verbose=verbose)
+                self.__training_model = clone_compiled(self.model)
+            elif self.__training_model is None and has_optimizer_state(self.model):
+                # a model loaded with its optimizer state continues training as it is, a copy of its weights serves meanwhile
+                serving_model = clone_compiled(self.model)
+                serving_model.set_weights(self.model.get_weights())
+                forward = self.__prepare_inference(serving_model)
+                self.__training_model, self.model = self.model, serving_model
+                self.__forward = forward
+            elif self.__training_model is None:
+                self.__training_model = clone_compiled(self.model)
+                self.__training_model.set_weights(self.model.get_weights())
+            training_model = self.__training_model
+
+            training_model.fit(generate_method(data='train'),
+                               steps_per_epoch=generator.train_batch_count,
+                               validation_data=generate_method(data='test'),
+                               validation_steps=generator.test_batch_count,
+                               epochs=epochs, verbose=verbose)
+
+            serving_model = self.__spare_model if self.__spare_model is not None else clone_compiled(self.model)
+            serving_model.set_weights(training_model.get_weights())
+
+            # single reference assignments, predict uses either the old or the new model, never a half-trained one
+            forward = self.__prepare_inference(serving_model)
+            self.__spare_model, self.model = self.model, serving_model
+            self.__forward = forward
+            # the exported artifact still holds the weights it started with
+            self.__serving = None
             # TODO fit gear etc. models
         except Exception as ex:
             print("Generator training exception: {}".format(ex))
@@ -89,27 +308,62 @@ class ModelWrapper:
     def predict(self, mem_frame, mem_telemetry):
         # prediction from frame and steering
         mem_steering = self.__memory.columns_from_memorized(mem_telemetry, columns=(1, 2,))
-        predictions = self.model.predict([mem_frame[np.newaxis, :], mem_steering[np.newaxis, :]])
+        frame_input = self.__single_inputs[0]
+        convert_frames(mem_frame, frame_input[0])
+        if len(self.__single_inputs) > 1:
+            self.__single_inputs[1][0] = mem_steering
+        predictions = self.__run_model(self.__single_inputs)
         # predictions = self.model.predict([mem_frame[np.newaxis, :], mem_frame[np.newaxis, :]])
         # gear_predictions = self.gear_model.predict([mem_frame[np.newaxis, :], mem_steering[np.newaxis, :]])
         gear_predictions = np.array([[1]])
 
         return updates_from_prediction(predictions, gear_predictions)
 
-    def evaluate_model(self, generator):
-        true_actions = []
-        pred_actions = []
-        for index in generator.train_indexes:
-            frame, telem, action = generator.load_single_pair(index)
-            pred_action = self.model.predict([frame[np.newaxis, :], telem[np.newaxis, :]])[0]
+    def predict_batch(self, mem_frames, mem_telemetries):
+        """One forward pass for several memorized instances, returns CarControlUpdates in input order."""
+        mem_steerings = self.__memory.columns_from_memorized_batch(mem_telemetries, columns=(1, 2,))
+        predictions = self.__run_model(self.__model_inputs(mem_frames, mem_steerings))
+        gear_predictions = np.ones((mem_frames.shape[0], 1))
+
+        return [updates_from_prediction(predictions[i:i + 1], gear_predictions[i:i + 1]) for i in range(mem_frames.shape[0])]
 
-            true_actions.append(action)
-            pred_actions.append(pred_action)
+    def output_mean_squared_errors(self, generator, indexes):
+        """Streams indexes of the generator in batches, returns the mean squared error per output or None without indexes."""
+        squared_errors = None
+        for start in range(0, len(indexes), generator.batch_size):
+            frames, telems, actions = generator.load_batch(indexes[start:start + generator.batch_size])
+            pred_actions = self.__run_model(self.__model_inputs(frames, telems))
 
-        mse = mean_squared_error(np.array(true_actions), np.array(pred_actions))
+            errors = np.square(actions.reshape(pred_actions.shape[0], -1) - pred_actions, dtype=np.float64)
+            batch_errors = errors.sum(axis=0)
+            squared_errors = batch_errors if squared_errors is None else squared_errors + batch_errors
+
+        if squared_errors is None:
+            return None
+        return squared_errors / len(indexes)
+
+    def evaluate_model(self, generator):
+        """
+        Streams generator.train_indexes in batches and accumulates squared errors per output.
+        MSE is the mean over outputs, as sklearn mean_squared_error, per output errors are kept in output_errors.
+        """
+        output_errors = self.output_mean_squared_errors(generator, generator.train_indexes)
+        if output_errors is None:
+            return
+
+        self.output_errors = output_errors
+        mse = float(np.mean(self.output_errors))
+        self.__evaluations += 1
         if self.min_error is None or mse < self.min_error:
+            # a single reference assignment swaps the best snapshot, the disk write happens in the background
+            snapshot = WeightSnapshot.of(self.model, mse, self.__evaluations)
             self.min_error = mse
-            self.min_err_model.set_weights(self.model.get_weights())
+            self.best = snapshot
+            self.__checkpoint(snapshot)
+
+
+def raise_inference_only(model_file):
+    raise ValueError('Model {} is inference only, DAgger needs a Keras model!'.format(model_file))
 
 
 def updates_from_prediction(prediction, gear_prediction):
@@ -125,13 +379,23 @@ def get_model_file_name(path_to_models: str):
     return 'dagger_num_{}'.format(model_num + 1)
 
 
+def find_latest_dagger_model(path_to_models):
+    """Newest dagger_num_* file name, the weight snapshot if it exists next to the full model, or None."""
+    model_files = [fn for fn in os.listdir(path_to_models) if fn.startswith('dagger_num_') and fn.endswith(('.h5', '.npz'))]
+    if len(model_files) == 0:
+        return None
+
+    return max(model_files, key=lambda fn: (int(fn.split('_')[2].split('.')[0]), fn.endswith('.npz')))
+
+
 def get_last_model_num(path_to_models, model_prefix):
-    model_files = [fn for fn in os.listdir(path_to_models) if fn.startswith(model_prefix) and fn.endswith('.h5')]
+    # weight snapshots of an interrupted session count as well, so the next session does not overwrite them
+    model_files = [fn for fn in os.listdir(path_to_models) if fn.startswith(model_prefix) and fn.endswith(('.h5', '.npz'))]
 
     if len(model_files) == 0:
         return 1
 
-    # expected format is "dagger_num_3.h5"
+    # expected format is "dagger_num_3.h5" or "dagger_num_3.npz"
     existing_nums = [int(fn.split('_')[2].split('.')[0]) for fn in model_files]
 
     latest_num = sorted(existing_nums)[-1]
@@ -10,6 +10,45 @@ def time_consistent_loss(y_true, y_pred, coef=0.5):
     return K.mean(K.square(y_pred - y_true), axis=-1) + 0.5 * K.mean(K.square(y_pred[1:] - y_pred[:-1]), axis=-1)
 
 
+def create_frame_input(input_shape, uint8_input=False):
+    """Returns the model input and the tensor to build on, uint8 frames are scaled to [0, 1] inside the model."""
+    from tensorflow.keras.layers import Input
+
+    if not uint8_input:
+        inputs = Input(shape=input_shape)
+        return inputs, inputs
+
+    from tensorflow.keras.layers.experimental.preprocessing import Rescaling
+
+    inputs = Input(shape=input_shape, dtype='uint8')
+    return inputs, Rescaling(1.0 / 255)(inputs)
+
+
+def compile_like(model, source=None):
+    """Compiles with a fresh copy of the source model's optimizer and its loss, or as the create functions do."""
+    from tensorflow.keras.optimizers import Adam
+    from tensorflow.keras.losses import mean_absolute_error
+
+    if source is not None and source.optimizer is not None:
+        optimizer = source.optimizer.__class__.from_config(source.optimizer.get_config())
+        model.compile(loss=source.loss, optimizer=optimizer)
+    else:
+        model.compile(loss=mean_absolute_error, optimizer=Adam(lr=3e-4))
+    return model
+
+
+def has_optimizer_state(model):
+    """Whether the model's optimizer has slot variables, e.g. from a training run saved into the file it was loaded from."""
+    return model.optimizer is not None and len(model.optimizer.weights) > 0
+
+
+def clone_compiled(model):
+    """Same architecture as model, input dtypes included, with newly initialized weights."""
+    from tensorflow.keras.models import clone_model
+
+    return compile_like(clone_model(model), model)
+
+
 def create_mlp(input_shape=(4,)):
     from tensorflow.keras.layers import Input
     from tensorflow.keras.layers import Dense
@@ -30,7 +69,7 @@ def create_mlp(input_shape=(4,)):
     return Model(inputs, dropout_5)
 
 
-def create_nvidia_cnn(input_shape=(40, 60, 3)):
+def create_nvidia_cnn(input_shape=(40, 60, 3), uint8_input=False):
     from tensorflow.keras.layers import Convolution2D
     from tensorflow.keras.regularizers import l2
     from tensorflow.keras.layers import Dense
@@ -39,8 +78,8 @@ def create_nvidia_cnn(input_shape=(40, 60, 3)):
     from tensorflow.keras.models import Model
 
     """ Architecture from https://github.com/tanelp/self-driving-convnet/blob/master/train.py"""
-    inputs = Input(shape=input_shape)
-    conv_1 = Convolution2D(24, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(inputs)
+    inputs, scaled_inputs = create_frame_input(input_shape, uint8_input)
+    conv_1 = Convolution2D(24, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(scaled_inputs)
     conv_2 = Convolution2D(36, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(conv_1)
     conv_3 = Convolution2D(48, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(conv_2)
     conv_4 = Convolution2D(64, kernel_size=(3, 3), kernel_regularizer=l2(0.0005), padding="same", activation="elu")(conv_3)
@@ -54,9 +93,9 @@ def create_nvidia_cnn(input_shape=(40, 60, 3)):
     return Model(inputs, dense_4)
 
 
-def create_standalone_nvidia_cnn(activation='linear', input_shape=(40, 60, 3), output_shape=1):
+def create_standalone_nvidia_cnn(activation='linear', input_shape=(40, 60, 3), output_shape=1, uint8_input=False):
     """
-    Activation: linear, softmax.
+    Activation: linear, softmax. uint8_input takes raw uint8 frames and scales them inside the model.
     Architecture is from nvidia paper mentioned in https://github.com/tanelp/self-driving-convnet/blob/master/train.py
     """
     from tensorflow.keras.layers import Convolution2D
@@ -68,8 +107,8 @@ def create_standalone_nvidia_cnn(activation='linear', input_shape=(40, 60, 3), o
     from tensorflow.keras.optimizers import Adam
     from tensorflow.keras.losses import mean_squared_error, mean_absolute_error
 
-    inputs = Input(shape=input_shape)
-    conv_1 = Convolution2D(24, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(inputs)
+    inputs, scaled_inputs = create_frame_input(input_shape, uint8_input)
+    conv_1 = Convolution2D(24, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(scaled_inputs)
     conv_2 = Convolution2D(36, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(conv_1)
     conv_3 = Convolution2D(48, kernel_size=(5, 5), kernel_regularizer=l2(0.0005), strides=(2, 2), padding="same", activation="elu")(conv_2)
     conv_4 = Convolution2D(64, kernel_size=(3, 3), kernel_regularizer=l2(0.0005), padding="same", activation="elu")(conv_3)
@@ -88,9 +127,9 @@ def create_standalone_nvidia_cnn(activation='linear', input_shape=(40, 60, 3), o
     return model
 
 
-def create_standalone_resnet(activation='linear', input_shape=(40, 60, 3), output_shape=1):
+def create_standalone_resnet(activation='linear', input_shape=(40, 60, 3), output_shape=1, uint8_input=False):
     """
-    Activation: linear, softmax.
+    Activation: linear, softmax. uint8_input takes raw uint8 frames and scales them inside the model.
     Architecture is a pre-trained ResNet50 followed by an MLP
     """
     from tensorflow.keras.regularizers import l2
@@ -102,8 +141,8 @@ def create_standalone_resnet(activation='linear', input_shape=(40, 60, 3), outpu
     from tensorflow.keras.losses import mean_squared_error, mean_absolute_error
     from tensorflow.keras.applications import ResNet50
 
-    inputs = Input(shape=input_shape)
-    conv_base = ResNet50(weights='imagenet', include_top=False)(inputs)
+    inputs, scaled_inputs = create_frame_input(input_shape, uint8_input)
+    conv_base = ResNet50(weights='imagenet', include_top=False)(scaled_inputs)
     conv_base.trainable = False
     flatten = Flatten()(conv_base)
 
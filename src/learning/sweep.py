@@ -0,0 +1,233 @@
+import os
+import json
+import glob
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.learning.models import create_mlp, create_nvidia_cnn, create_standalone_nvidia_cnn, create_standalone_resnet, \
+                                create_multi_model_3
+
+
+def build_standalone_nvidia_cnn(frame_shape, numeric_shape, diff_shape, uint8_input):
+    return create_standalone_nvidia_cnn(activation='linear', input_shape=frame_shape, output_shape=diff_shape, uint8_input=uint8_input), False
+
+
+def build_standalone_resnet(frame_shape, numeric_shape, diff_shape, uint8_input):
+    return create_standalone_resnet(activation='linear', input_shape=frame_shape, output_shape=diff_shape, uint8_input=uint8_input), False
+
+
+def build_multi_model_3(frame_shape, numeric_shape, diff_shape, uint8_input):
+    mlp = create_mlp(input_shape=numeric_shape)
+    cnn = create_nvidia_cnn(input_shape=frame_shape, uint8_input=uint8_input)
+    return create_multi_model_3(mlp, cnn, output_shape=diff_shape), True
+
+
+# builders return the compiled model and whether it takes the numeric input as well
+MODEL_BUILDERS = {
+    'standalone_nvidia_cnn': build_standalone_nvidia_cnn,
+    'standalone_resnet': build_standalone_resnet,
+    'multi_model_3': build_multi_model_3
+}
+
+
+def result_key(builder_name, memory, with_builder=False):
+    key = 'N={}, M={}'.format(*memory)
+    return '{}: {}'.format(builder_name, key) if with_builder else key
+
+
+class SweepJob:
+    def __init__(self, key, builder_name, memory, epochs, batch_size, column_mode, base_path, results_path, threads, use_gpu):
+        self.key = key
+        self.builder_name = builder_name
+        self.memory = memory
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.column_mode = column_mode
+        self.base_path = base_path
+        self.results_path = results_path
+        self.threads = threads
+        self.use_gpu = use_gpu
+
+    @property
+    def slug(self):
+        return '{}_n{}_m{}'.format(self.builder_name, *self.memory)
+
+    def checkpoint_file(self, epoch):
+        return '{}{}_e{:03d}.h5'.format(self.results_path, self.slug, epoch)
+
+    def checkpoints(self):
+        """Existing checkpoints as (epoch, file), oldest first."""
+        files = glob.glob('{}{}_e*.h5'.format(self.results_path, self.slug))
+        return sorted((int(checkpoint[-6:-3]), checkpoint) for checkpoint in files)
+
+
+def append_result(results_file, record):
+    # one write per line on an O_APPEND descriptor, so lines from concurrent jobs do not interleave
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(results_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_results(results_file):
+    """Per key, the latest losses recorded for every epoch and whether the job finished."""
+    progress = {}
+    if not os.path.isfile(results_file):
+        return progress
+
+    with open(results_file) as results:
+        for line in results:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # line cut short by an interruption
+                continue
+
+            entry = progress.setdefault(record['key'], {'epochs': {}, 'done': False})
+            if record.get('done'):
+                entry['done'] = True
+            else:
+                entry['epochs'][record['epoch']] = (record['loss'], record['val_loss'])
+    return progress
+
+
+def collect_results(results_file):
+    """Result dict of finished jobs in the memory test format, {key: losses, key + '_val': validation losses}."""
+    results = {}
+    for key, entry in read_results(results_file).items():
+        if not entry['done']:
+            continue
+        epochs = sorted(entry['epochs'])
+        results[key] = [entry['epochs'][epoch][0] for epoch in epochs]
+        results[key + '_val'] = [entry['epochs'][epoch][1] for epoch in epochs]
+    return results
+
+
+def limit_threads(threads, use_gpu):
+    # has to happen before TensorFlow is imported in the worker
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS'):
+        os.environ[variable] = str(threads)
+    os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    if not use_gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def train_job(job, results_file):
+    """Trains one memory variant in a worker process, continuing from its latest epoch checkpoint if there is one."""
+    limit_threads(job.threads, job.use_gpu)
+
+    from tensorflow.keras.callbacks import Callback
+    from tensorflow.keras.models import load_model
+    from commons.configuration_manager import ConfigurationManager
+    from src.learning.training.generator import Generator
+    from src.learning.training.prefetcher import BatchPrefetcher
+
+    config = ConfigurationManager().config
+    uint8_input = config.frame_dtype == 'uint8'
+    generator = Generator(config, memory_tuple=job.memory, base_path=job.base_path, batch_size=job.batch_size,
+                          column_mode=job.column_mode, frame_dtype=config.frame_dtype)
+    frame_shape, numeric_shape, diff_shape = generator.get_shapes()
+
+    model, with_numeric = MODEL_BUILDERS[job.builder_name](frame_shape, numeric_shape, diff_shape, uint8_input)
+
+    checkpoints = job.checkpoints()
+    initial_epoch = 0
+    if len(checkpoints) > 0:
+        initial_epoch, checkpoint_file = checkpoints[-1]
+        model = load_model(checkpoint_file)
+        logging.info("{} continues after epoch {}".format(job.key, initial_epoch))
+
+    class EpochResults(Callback):
+        def on_epoch_end(self, epoch, logs=None):
+            append_result(results_file, {'key': job.key, 'epoch': epoch + 1, 'loss': float(logs['loss']), 'val_loss': float(logs['val_loss'])})
+
+            # the results line comes first, a rerun epoch then overwrites its losses instead of missing them
+            partial_file = '{}{}_partial.h5'.format(job.results_path, job.slug)
+            self.model.save(partial_file)
+            os.replace(partial_file, job.checkpoint_file(epoch + 1))
+            for old_epoch, old_checkpoint in job.checkpoints():
+                if old_epoch != epoch + 1:
+                    os.remove(old_checkpoint)
+
+    loader = BatchPrefetcher(generator, workers=1, queue_depth=2)
+    generate_method = loader.generate_with_numeric if with_numeric else loader.generate
+
+    model.fit(generate_method(data='train'),
+              steps_per_epoch=generator.train_batch_count,
+              validation_data=generate_method(data='test'),
+              validation_steps=generator.test_batch_count,
+              initial_epoch=initial_epoch, epochs=job.epochs, verbose=0, callbacks=[EpochResults()])
+
+    append_result(results_file, {'key': job.key, 'done': True})
+    return job.key
+
+
+def run_sweep(memory_variants, builder_names, base_path, results_path, epochs=11, batch_size=32, column_mode='steer',
+              workers=2, threads_per_job=None, use_gpu=False):
+    """Trains every builder on every memory variant across a spawned process pool, skipping jobs finished earlier."""
+    if not os.path.isdir(results_path):
+        os.makedirs(results_path)
+    results_file = results_path + 'results.jsonl'
+    if threads_per_job is None:
+        threads_per_job = max(1, (os.cpu_count() or 1) // workers)
+
+    progress = read_results(results_file)
+    with_builder = len(builder_names) > 1
+
+    jobs = []
+    for builder_name in builder_names:
+        for memory in memory_variants:
+            key = result_key(builder_name, memory, with_builder)
+            if progress.get(key, {}).get('done'):
+                logging.info("{} already finished".format(key))
+                continue
+            jobs.append(SweepJob(key, builder_name, tuple(memory), epochs, batch_size, column_mode, base_path, results_path,
+                                 threads_per_job, use_gpu))
+
+    logging.info("Training {} jobs on {} workers with {} threads each".format(len(jobs), workers, threads_per_job))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(train_job, job, results_file): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            try:
+                future.result()
+                logging.info("[{}/{}] {} finished".format(done, len(jobs), job.key))
+            except Exception as ex:
+                logging.error("[{}/{}] {} failed: {}".format(done, len(jobs), job.key, ex))
+
+    return collect_results(results_file)
+
+
+def parse_memory(value):
+    length, interval = value.split(',')
+    return int(length), int(interval)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description='Trains memory variants concurrently, resumable, in the memory test result format.')
+    parser.add_argument('--memory', type=parse_memory, nargs='+', default=[(1, 1)], help='length,interval pairs, e.g. 1,1 4,2')
+    parser.add_argument('--builders', nargs='+', default=['standalone_nvidia_cnn'], choices=sorted(MODEL_BUILDERS))
+    parser.add_argument('--base-path', default='../../training/')
+    parser.add_argument('--results-path', default='../../training/sweep/')
+    parser.add_argument('--epochs', type=int, default=11)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--column-mode', default='steer')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads-per-job', type=int, default=None)
+    parser.add_argument('--gpu', action='store_true')
+    args = parser.parse_args()
+
+    results = run_sweep(args.memory, args.builders, args.base_path, args.results_path, epochs=args.epochs, batch_size=args.batch_size,
+                        column_mode=args.column_mode, workers=args.workers, threads_per_job=args.threads_per_job, use_gpu=args.gpu)
+    print(results)
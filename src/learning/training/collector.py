@@ -1,6 +1,42 @@
+import operator
+import numpy as np
+
 from src.learning.training.car_mapping import CarMapping
 
 
+class TelemetryExtractor:
+    """
+    Copies a fixed list of telemetry columns from a message dict into a reused vector.
+    Missing columns raise a KeyError, unless missing_value is given to fill them with.
+    """
+    def __init__(self, columns, dtype=np.float64, missing_value=None):
+        self.columns = tuple(columns)
+        self.missing_value = missing_value
+
+        self.__vector = np.zeros(len(self.columns), dtype=dtype)
+        self.__getter = operator.itemgetter(*self.columns)
+
+    def extract(self, telemetry):
+        try:
+            values = self.__getter(telemetry)
+        except KeyError:
+            values = self.__extract_with_missing(telemetry)
+
+        if len(self.columns) == 1:
+            self.__vector[0] = values
+        else:
+            self.__vector[:] = values
+        return self.__vector
+
+    def __extract_with_missing(self, telemetry):
+        if self.missing_value is None:
+            missing = [column for column in self.columns if column not in telemetry]
+            raise KeyError('Telemetry is missing columns {}'.format(missing))
+
+        values = tuple(telemetry.get(column, self.missing_value) for column in self.columns)
+        return values[0] if len(self.columns) == 1 else values
+
+
 class Collector:
     def __init__(self):
         self.__mapping = CarMapping()
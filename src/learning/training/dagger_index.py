@@ -0,0 +1,75 @@
+import os
+import threading
+import numpy as np
+
+
+class DaggerIndexFiles:
+    split = 'split_{}.bin'
+
+
+class DaggerIndex:
+    """
+    Append-only train/test assignment of the DAgger aggregate, one byte per sample on disk (0 train, 1 test).
+    Samples are assigned once when registered, so the split only grows and never reshuffles between iterations.
+    """
+    TRAIN = 0
+    TEST = 1
+
+    def __init__(self, path, memory_string, test_size=0.2, seed=0):
+        self.file = path + DaggerIndexFiles.split.format(memory_string)
+        self.test_size = test_size
+        self.seed = seed
+
+        self.__lock = threading.Lock()
+        self.__flags = np.empty(1024, dtype=np.uint8)
+        self.count = 0
+
+        if os.path.isfile(self.file):
+            self.__append(np.fromfile(self.file, dtype=np.uint8))
+
+    def __append(self, flags):
+        if self.count + flags.shape[0] > self.__flags.shape[0]:
+            grown = np.empty(max(2 * self.__flags.shape[0], self.count + flags.shape[0]), dtype=np.uint8)
+            grown[:self.count] = self.__flags[:self.count]
+            self.__flags = grown
+
+        self.__flags[self.count:self.count + flags.shape[0]] = flags
+        self.count += flags.shape[0]
+
+    def __assign(self, start, count):
+        # seeded by the batch position, rebuilding the aggregate batch by batch reproduces the split
+        draws = np.random.RandomState((self.seed, start)).random_sample(count)
+        return np.where(draws < self.test_size, self.TEST, self.TRAIN).astype(np.uint8)
+
+    def register(self, count):
+        """Assigns count new samples, appended after the registered ones, and returns their indexes."""
+        with self.__lock:
+            start = self.count
+            flags = self.__assign(start, count)
+            with open(self.file, 'ab') as split_file:
+                split_file.write(flags.tobytes())
+                split_file.flush()
+                os.fsync(split_file.fileno())
+            self.__append(flags)
+
+        return np.arange(start, start + count)
+
+    def reconcile(self, stored_count):
+        """Matches the index to the stored sample count, after an interruption between storing and registering."""
+        with self.__lock:
+            missing = stored_count - self.count
+            if missing < 0:
+                self.count = stored_count
+                with open(self.file, 'r+b') as split_file:
+                    split_file.truncate(stored_count)
+        if missing > 0:
+            self.register(missing)
+
+    def split(self):
+        """Train and test indexes of every registered sample."""
+        with self.__lock:
+            flags = self.__flags[:self.count]
+            return np.flatnonzero(flags == self.TRAIN), np.flatnonzero(flags == self.TEST)
+
+    def __len__(self):
+        return self.count
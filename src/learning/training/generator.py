@@ -1,8 +1,12 @@
 import os
+import glob
+import hashlib
 import numpy as np
 from sklearn.model_selection import train_test_split
 
 from src.utilities.memory_maker import MemoryMaker
+from src.learning.training.packed_store import PackedReader, is_packed
+from src.utilities.transformer import convert_frames
 
 
 class GenFiles:
@@ -15,7 +19,12 @@ class GenFiles:
 
 
 class Generator:
-    def __init__(self, config, memory_tuple=None, base_path=None, eval_mode=False, batch_size=32, column_mode='all', test_size=0.2, index_override=None):
+    def __init__(self, config, memory_tuple=None, base_path=None, eval_mode=False, batch_size=32, column_mode='all', test_size=0.2, index_override=None,
+                 frame_dtype=None, split_override=None):
+        """
+        frame_dtype converts stored frames between uint8 and float32 for the model, None yields them as stored.
+        split_override is a (train_indexes, test_indexes) pair used as is, e.g. the split of a DaggerIndex.
+        """
         # TODO the whole initialization is a bit of a mess now, should refactor
         if memory_tuple is not None:
             self.__memory = MemoryMaker(config, memory_tuple)
@@ -36,16 +45,59 @@ class Generator:
 
         self.batch_size = batch_size
         self.column_mode = column_mode
+        self.test_size = test_size
+        self.frame_dtype = None if frame_dtype is None else np.dtype(frame_dtype)
+        self.__store = self.__open_store()
+        self.__cache_files = {}
+
+        if split_override is not None:
+            self.__set_split(*split_override)
+            return
 
         if index_override is not None:
             indexes = index_override
         else:
             indexes = self.__apply_upsampling()
-        self.train_indexes, self.test_indexes = train_test_split(indexes, test_size=test_size, shuffle=True)
+        self.__set_split(*train_test_split(indexes, test_size=test_size, shuffle=True))
+
+    def __open_store(self):
+        return PackedReader(self.path, self.memory_string) if is_packed(self.path, self.memory_string) else None
+
+    def __set_split(self, train_indexes, test_indexes):
+        # generate shuffles its indexes in place, the caller's arrays are left alone
+        self.train_indexes = np.array(train_indexes)
+        self.test_indexes = np.array(test_indexes)
 
         self.train_batch_count = len(self.train_indexes) // self.batch_size
         self.test_batch_count = len(self.test_indexes) // self.batch_size
 
+    def refresh(self, split_override=None):
+        """
+        Picks up samples appended to the store since the last refresh, for reuse across DAgger iterations.
+        The existing split is kept, only new samples are split, unless split_override replaces it.
+        """
+        known_count = self.__count_known()
+        self.__store = self.__open_store()
+        self.__cache_files = {}
+
+        if split_override is not None:
+            self.__set_split(*split_override)
+            return
+
+        new_indexes = np.arange(known_count, self.__count_instances())
+        if len(new_indexes) == 0:
+            return
+        if not self.session_mode:
+            raise ValueError('Only session generators can be refreshed without a split!')
+
+        new_train, new_test = train_test_split(new_indexes, test_size=self.test_size, shuffle=True) if len(new_indexes) > 1 else (new_indexes, new_indexes[:0])
+        self.__set_split(np.concatenate((self.train_indexes, new_train)), np.concatenate((self.test_indexes, new_test)))
+
+    def __count_known(self):
+        if len(self.train_indexes) + len(self.test_indexes) == 0:
+            return 0
+        return int(max(np.max(self.train_indexes, initial=-1), np.max(self.test_indexes, initial=-1))) + 1
+
     def __apply_upsampling(self):
         indexes = np.arange(self.__count_instances())
         if self.session_mode:
@@ -66,6 +118,8 @@ class Generator:
         return np.repeat(indexes, sampling_multipliers)
 
     def __count_instances(self):
+        if self.__store is not None:
+            return len(self.__store)
         return len([fn for fn in os.listdir(self.path) if fn.startswith('frame_')])
 
     def get_shapes(self):
@@ -77,30 +131,90 @@ class Generator:
         return frame.shape, numeric.shape, diff.shape[0]
 
     def generate(self, data='train'):
-        batch_count, indexes = self.__evaluate_indexes(data)
+        batch_count, indexes = self.evaluate_indexes(data)
 
         while True:
             np.random.shuffle(indexes)
 
             for i in range(batch_count):
                 batch_indexes = indexes[i * self.batch_size:(i + 1) * self.batch_size]
-                x_frame, x_numeric, y = self.__load_batch(batch_indexes)
+                x_frame, x_numeric, y = self.load_batch(batch_indexes)
 
                 yield x_frame, y
 
     def generate_with_numeric(self, data='train'):
-        batch_count, indexes = self.__evaluate_indexes(data)
+        batch_count, indexes = self.evaluate_indexes(data)
 
         while True:
             np.random.shuffle(indexes)
 
             for i in range(batch_count):
                 batch_indexes = indexes[i * self.batch_size:(i + 1) * self.batch_size]
-                x_frame, x_numeric, y = self.__load_batch(batch_indexes)
+                x_frame, x_numeric, y = self.load_batch(batch_indexes)
 
                 yield (x_frame, x_numeric), y
 
-    def __evaluate_indexes(self, data):
+    def dataset(self, data='train', with_numeric=False, cache=None):
+        """
+        Returns a repeating tf.data.Dataset over the same indexes as generate.
+        cache: None, 'memory' or a file path. Without caching, batches are loaded with load_batch in parallel,
+        with caching single samples are cached after the first epoch in a fixed random order and shuffled through a buffer.
+        A file cache gets its own name per data split and index set, the previous one of the same split is removed.
+        """
+        import tensorflow as tf
+
+        batch_count, indexes = self.evaluate_indexes(data)
+        frame, numeric, diff = self.load_single_pair(indexes[0])
+        types = (tf.as_dtype(frame.dtype), tf.as_dtype(numeric.dtype), tf.as_dtype(np.asarray(diff).dtype))
+        shapes = (frame.shape, numeric.shape, np.asarray(diff).shape)
+
+        def load_samples(sample_indexes):
+            if sample_indexes.ndim == 0:
+                return tuple(np.asarray(array) for array in self.load_single_pair(int(sample_indexes)))
+            return self.load_batch(sample_indexes)
+
+        def tf_load(sample_indexes):
+            loaded = tf.numpy_function(load_samples, [sample_indexes], types)
+            batch_shape = () if cache is not None else (self.batch_size,)
+            for tensor, shape in zip(loaded, shapes):
+                tensor.set_shape(batch_shape + shape)
+
+            x_frame, x_numeric, y = loaded
+            if with_numeric:
+                return (x_frame, x_numeric), y
+            return x_frame, y
+
+        if cache is not None:
+            # the cached samples keep this order and a buffer of all of them would not fit, permuting once decorrelates
+            # the cached order itself and the buffer below only varies it between epochs
+            indexes = np.random.RandomState(0).permutation(indexes)
+
+        dataset = tf.data.Dataset.from_tensor_slices(indexes)
+        if cache is None:
+            dataset = dataset.shuffle(len(indexes), reshuffle_each_iteration=True)
+            dataset = dataset.batch(self.batch_size, drop_remainder=True)
+            dataset = dataset.map(tf_load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        else:
+            dataset = dataset.map(tf_load, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+            dataset = dataset.cache('' if cache == 'memory' else self.__cache_file(cache, data, indexes))
+            dataset = dataset.shuffle(min(len(indexes), 100 * self.batch_size), reshuffle_each_iteration=True)
+            dataset = dataset.batch(self.batch_size, drop_remainder=True)
+
+        return dataset.repeat().prefetch(tf.data.experimental.AUTOTUNE)
+
+    def __cache_file(self, cache, data, indexes):
+        # train and test must not share a cache, nor may a refreshed split reuse the samples cached before it
+        digest = hashlib.sha1(np.sort(indexes).tobytes()).hexdigest()[:12]
+        cache_file = '{}_{}_{}_{}'.format(cache, data, len(indexes), digest)
+
+        previous = self.__cache_files.get(data)
+        if previous is not None and previous != cache_file:
+            for previous_file in glob.glob(previous + '*'):
+                os.remove(previous_file)
+        self.__cache_files[data] = cache_file
+        return cache_file
+
+    def evaluate_indexes(self, data):
         if data == 'train':
             indexes = self.train_indexes
             batch_count = self.train_batch_count
@@ -112,7 +226,7 @@ class Generator:
         return batch_count, indexes
 
     def generate_single_train(self, shuffle=True):
-        batch_count, indexes = self.__evaluate_indexes('train')
+        batch_count, indexes = self.evaluate_indexes('train')
         while True:
             if shuffle:
                 np.random.shuffle(indexes)
@@ -122,7 +236,7 @@ class Generator:
                 yield x_frame, y
 
     def generate_single_train_with_numeric(self, shuffle=True):
-        batch_count, indexes = self.__evaluate_indexes('train')
+        batch_count, indexes = self.evaluate_indexes('train')
         while True:
             if shuffle:
                 np.random.shuffle(indexes)
@@ -132,7 +246,7 @@ class Generator:
                 yield x_frame, x_numeric, y
 
     def generate_single_test(self, shuffle=True):
-        batch_count, indexes = self.__evaluate_indexes('test')
+        batch_count, indexes = self.evaluate_indexes('test')
         while True:
             if shuffle:
                 np.random.shuffle(indexes)
@@ -142,7 +256,7 @@ class Generator:
                 yield x_frame, y
 
     def generate_single_test_with_numeric(self, shuffle=True):
-        batch_count, indexes = self.__evaluate_indexes('test')
+        batch_count, indexes = self.evaluate_indexes('test')
         while True:
             if shuffle:
                 np.random.shuffle(indexes)
@@ -151,24 +265,70 @@ class Generator:
                 x_frame, x_numeric, y = self.load_single_pair(index)
                 yield x_frame, x_numeric, y
 
-    def __load_batch(self, batch_indexes):
-        frames = []
-        numerics = []
-        diffs = []
+    def load_batch(self, batch_indexes, out=None):
+        """Optional out is a preallocated (frames, numerics, diffs) tuple the batch is written into."""
+        if self.__store is not None:
+            if self.__converts(self.__store.frames.dtype):
+                frames, numerics, diffs = self.__store.load_batch(batch_indexes)
+                frames = convert_frames(frames, np.empty(frames.shape, self.frame_dtype) if out is None else out[0])
+            else:
+                frames, numerics, diffs = self.__store.load_batch(batch_indexes, frames_out=None if out is None else out[0])
+            frames, numerics, diffs = self.__select_batch_columns(frames, numerics, diffs)
+        elif out is not None:
+            for i, index in enumerate(batch_indexes):
+                out[0][i], out[1][i], out[2][i] = self.load_single_pair(index)
+            return out
+        else:
+            frames = []
+            numerics = []
+            diffs = []
+
+            for i in batch_indexes:
+                frame, numeric, diff = self.load_single_pair(i)
+
+                frames.append(frame)
+                numerics.append(numeric)
+                diffs.append(diff)
+
+            return np.array(frames), np.array(numerics), np.array(diffs)
+
+        if out is None:
+            return frames, numerics, diffs
 
-        for i in batch_indexes:
-            frame, numeric, diff = self.load_single_pair(i)
+        np.copyto(out[1], numerics)
+        np.copyto(out[2], diffs)
+        return out
 
-            frames.append(frame)
-            numerics.append(numeric)
-            diffs.append(diff)
+    def __converts(self, stored_dtype):
+        return self.frame_dtype is not None and self.frame_dtype != stored_dtype
 
-        return np.array(frames), np.array(numerics), np.array(diffs)
+    def __select_batch_columns(self, frames, numerics, diffs):
+        if self.column_mode == 'steer':
+            numerics = self.__memory.columns_from_memorized_batch(numerics, columns=(1, 2,))
+            diffs = diffs[:, 1:3]
+        elif self.column_mode == 'throttle':
+            pass
+        elif self.column_mode == 'gear':
+            numerics = self.__memory.columns_from_memorized_batch(numerics, columns=(0,))
+            diffs = diffs[:, 0]
+        elif self.column_mode == 'all':
+            numerics = self.__memory.columns_from_memorized_batch(numerics, columns=(0, 1, 2,))
+            diffs = diffs[:, 0:3]
+        else:
+            raise ValueError('Misconfigured generator column mode!')
+
+        return frames, numerics, diffs
 
     def load_single_pair(self, index):
-        frame = np.load(self.path + GenFiles.frame.format(self.memory_string, index), allow_pickle=True)
-        numeric = np.load(self.path + GenFiles.numeric.format(self.memory_string, index), allow_pickle=True)
-        diff = np.load(self.path + GenFiles.diff.format(self.memory_string, index), allow_pickle=True)
+        if self.__store is not None:
+            frame, numeric, diff = self.__store.load_single(index)
+        else:
+            frame = np.load(self.path + GenFiles.frame.format(self.memory_string, index), allow_pickle=True)
+            numeric = np.load(self.path + GenFiles.numeric.format(self.memory_string, index), allow_pickle=True)
+            diff = np.load(self.path + GenFiles.diff.format(self.memory_string, index), allow_pickle=True)
+
+        if self.__converts(frame.dtype):
+            frame = convert_frames(frame, np.empty(frame.shape, self.frame_dtype))
 
         if self.column_mode == 'steer':
             # steering + throttle
@@ -0,0 +1,158 @@
+import os
+import json
+import numpy as np
+
+
+class PackedFiles:
+    frames = 'frames_{}.npy'
+    numerics = 'numerics_{}.npy'
+    diffs = 'diffs_{}.npy'
+    header = 'header_{}.json'
+
+
+def is_packed(path, memory_string):
+    return os.path.isfile(path + PackedFiles.header.format(memory_string))
+
+
+def read_header(path, memory_string):
+    with open(path + PackedFiles.header.format(memory_string), 'r') as header_file:
+        return json.load(header_file)
+
+
+class PackedWriter:
+    """
+    Appends samples into preallocated memory-mapped frame, numeric and diff arrays.
+    The header holds the committed sample count, capacity grows by doubling.
+    """
+    def __init__(self, path, memory_string, capacity=1024):
+        self.path = path
+        self.memory_string = memory_string
+        self.initial_capacity = capacity
+
+        self.count = 0
+        self.capacity = 0
+        self.__arrays = None
+
+        if is_packed(path, memory_string):
+            self.count = read_header(path, memory_string)['count']
+            self.__arrays = [np.load(self.__file(name), mmap_mode='r+') for name in self.__names()]
+            self.capacity = self.__arrays[0].shape[0]
+
+    def __names(self):
+        return PackedFiles.frames, PackedFiles.numerics, PackedFiles.diffs
+
+    def __file(self, name):
+        return self.path + name.format(self.memory_string)
+
+    def append(self, frame, numeric, diff):
+        self.append_batch(frame[np.newaxis], np.asarray(numeric)[np.newaxis], np.asarray(diff)[np.newaxis])
+
+    def append_batch(self, frames, numerics, diffs):
+        batch_size = frames.shape[0]
+        assert batch_size == numerics.shape[0] == diffs.shape[0], 'Batch lengths differ!'
+
+        if self.__arrays is None:
+            self.__allocate((frames, numerics, diffs), max(self.initial_capacity, batch_size))
+        elif self.count + batch_size > self.capacity:
+            self.__grow(max(2 * self.capacity, self.count + batch_size))
+
+        for array, batch in zip(self.__arrays, (frames, numerics, diffs)):
+            array[self.count:self.count + batch_size] = batch
+        self.count += batch_size
+
+    def __allocate(self, batches, capacity):
+        self.__arrays = []
+        for name, batch in zip(self.__names(), batches):
+            array = np.lib.format.open_memmap(self.__file(name), mode='w+', dtype=batch.dtype,
+                                              shape=(capacity, *batch.shape[1:]))
+            self.__arrays.append(array)
+        self.capacity = capacity
+
+    def __grow(self, capacity):
+        grown = []
+        for name, array in zip(self.__names(), self.__arrays):
+            tmp_file = self.__file(name) + '.tmp'
+            new_array = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=array.dtype,
+                                                  shape=(capacity, *array.shape[1:]))
+            new_array[:self.count] = array[:self.count]
+            new_array.flush()
+
+            # readers that are still open keep the old mapping and their own count
+            os.replace(tmp_file, self.__file(name))
+            grown.append(new_array)
+
+        self.__arrays = grown
+        self.capacity = capacity
+
+    def flush(self):
+        if self.__arrays is None:
+            return
+
+        for array in self.__arrays:
+            array.flush()
+
+        header = {
+            'count': self.count,
+            'capacity': self.capacity,
+            'frame_dtype': str(self.__arrays[0].dtype),
+            'frame_shape': list(self.__arrays[0].shape[1:]),
+            'numeric_shape': list(self.__arrays[1].shape[1:]),
+            'diff_shape': list(self.__arrays[2].shape[1:])
+        }
+        header_file = self.__file(PackedFiles.header)
+        with open(header_file + '.tmp', 'w') as tmp_file:
+            json.dump(header, tmp_file)
+        os.replace(header_file + '.tmp', header_file)
+
+    def close(self):
+        self.flush()
+        self.__arrays = None
+
+
+class PackedReader:
+    def __init__(self, path, memory_string):
+        self.count = read_header(path, memory_string)['count']
+
+        self.frames = np.load(path + PackedFiles.frames.format(memory_string), mmap_mode='r')[:self.count]
+        self.numerics = np.load(path + PackedFiles.numerics.format(memory_string), mmap_mode='r')[:self.count]
+        self.diffs = np.load(path + PackedFiles.diffs.format(memory_string), mmap_mode='r')[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def load_single(self, index):
+        return np.array(self.frames[index]), np.array(self.numerics[index]), np.array(self.diffs[index])
+
+    def load_batch(self, indexes, frames_out=None):
+        if frames_out is None:
+            frames = self.frames[indexes]
+        else:
+            # mode='raise' would make np.take buffer the output, the bounds are checked once per batch instead
+            indexes = np.asarray(indexes)
+            if indexes.size > 0 and (indexes.min() < 0 or indexes.max() >= self.count):
+                raise IndexError('Batch indexes outside of the {} stored samples!'.format(self.count))
+            frames = np.take(self.frames, indexes, axis=0, out=frames_out, mode='clip')
+
+        return frames, self.numerics[indexes], self.diffs[indexes]
+
+
+def convert_genfiles(path, memory_string, remove_genfiles=False):
+    """Packs an existing GenFiles directory, returns the number of converted samples."""
+    from src.learning.training.generator import GenFiles
+
+    count = len([fn for fn in os.listdir(path) if fn.startswith('frame_')])
+    writer = PackedWriter(path, memory_string, capacity=max(count, 1))
+
+    for i in range(count):
+        writer.append(np.load(path + GenFiles.frame.format(memory_string, i), allow_pickle=True),
+                      np.load(path + GenFiles.numeric.format(memory_string, i), allow_pickle=True),
+                      np.load(path + GenFiles.diff.format(memory_string, i), allow_pickle=True))
+    writer.close()
+
+    if remove_genfiles:
+        for i in range(count):
+            os.remove(path + GenFiles.frame.format(memory_string, i))
+            os.remove(path + GenFiles.numeric.format(memory_string, i))
+            os.remove(path + GenFiles.diff.format(memory_string, i))
+
+    return count
@@ -0,0 +1,153 @@
+import time
+import queue
+import collections
+import logging
+import threading
+import numpy as np
+
+# slots the consumer keeps before returning the oldest one
+HELD_SLOTS = 2
+
+
+class LoaderStats:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.batches = 0
+            self.wait_time = 0.0
+            self.compute_time = 0.0
+            self.load_time = 0.0
+
+    def add_load(self, seconds):
+        with self.__lock:
+            self.load_time += seconds
+
+    def add_step(self, wait_seconds, compute_seconds):
+        with self.__lock:
+            self.batches += 1
+            self.wait_time += wait_seconds
+            self.compute_time += compute_seconds
+
+    def summary(self):
+        with self.__lock:
+            total = self.wait_time + self.compute_time
+            return {
+                'batches': self.batches,
+                'wait_time': self.wait_time,
+                'compute_time': self.compute_time,
+                'worker_load_time': self.load_time,
+                'wait_ratio': self.wait_time / total if total > 0 else 0.0
+            }
+
+
+class BatchPrefetcher:
+    """
+    Wraps a Generator and loads batches ahead of the consumer on worker threads into preallocated buffers.
+    Exposes the same generate methods and batch counts as Generator, so it can be passed to ModelWrapper.fit.
+    A yielded batch stays valid until two more have been requested, its buffers are then reused.
+    Keras' generator adapter reads one element ahead, so the batch being trained on is the one before the last yielded.
+    """
+    def __init__(self, generator, workers=2, queue_depth=4):
+        assert workers > 0 and queue_depth > 0, 'Prefetcher needs at least one worker and queue slot!'
+        self.generator = generator
+        self.workers = workers
+        self.queue_depth = queue_depth
+
+        self.batch_size = generator.batch_size
+        self.train_batch_count = generator.train_batch_count
+        self.test_batch_count = generator.test_batch_count
+
+        self.stats = LoaderStats()
+
+    def generate(self, data='train'):
+        for x_frame, x_numeric, y in self.__prefetch(data):
+            yield x_frame, y
+
+    def generate_with_numeric(self, data='train'):
+        for x_frame, x_numeric, y in self.__prefetch(data):
+            yield (x_frame, x_numeric), y
+
+    def __allocate_slots(self, indexes):
+        template = self.generator.load_batch(indexes[:self.batch_size])
+        # two extra slots are held by the consumer, the batch in the train step and the one read ahead, workers fill the rest
+        return [tuple(np.empty_like(array) for array in template) for _ in range(self.queue_depth + HELD_SLOTS)]
+
+    def __batch_tasks(self, indexes, batch_count):
+        sequence = 0
+        while True:
+            shuffled = np.random.permutation(indexes)
+            for i in range(batch_count):
+                yield sequence, shuffled[i * self.batch_size:(i + 1) * self.batch_size]
+                sequence += 1
+
+    def __prefetch(self, data):
+        batch_count, indexes = self.generator.evaluate_indexes(data)
+        if batch_count == 0:
+            return
+
+        slots = self.__allocate_slots(indexes)
+        free_slots = queue.Queue()
+        for slot in range(len(slots)):
+            free_slots.put(slot)
+
+        tasks = self.__batch_tasks(indexes, batch_count)
+        task_lock = threading.Lock()
+        ready = {}
+        ready_condition = threading.Condition()
+        stop = threading.Event()
+
+        def work():
+            while not stop.is_set():
+                try:
+                    slot = free_slots.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                with task_lock:
+                    sequence, batch_indexes = next(tasks)
+
+                start = time.perf_counter()
+                try:
+                    result = self.generator.load_batch(batch_indexes, out=slots[slot])
+                except Exception as ex:
+                    result = ex
+                self.stats.add_load(time.perf_counter() - start)
+
+                with ready_condition:
+                    ready[sequence] = (slot, result)
+                    ready_condition.notify_all()
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        sequence = 0
+        held_slots = collections.deque()
+        compute_start = None
+        try:
+            while True:
+                wait_start = time.perf_counter()
+                compute_time = 0.0 if compute_start is None else wait_start - compute_start
+
+                if len(held_slots) == HELD_SLOTS:
+                    free_slots.put(held_slots.popleft())
+
+                with ready_condition:
+                    while sequence not in ready:
+                        ready_condition.wait()
+                    held_slot, result = ready.pop(sequence)
+                held_slots.append(held_slot)
+                sequence += 1
+
+                if isinstance(result, Exception):
+                    raise result
+
+                compute_start = time.perf_counter()
+                self.stats.add_step(compute_start - wait_start, compute_time)
+                yield result
+        finally:
+            stop.set()
+            logging.debug('Prefetcher stopped: {}'.format(self.stats.summary()))
@@ -0,0 +1,186 @@
+import os
+import glob
+import time
+import shutil
+import logging
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.learning.training.collector import Collector
+from src.learning.training.generator import GenFiles
+from src.learning.training.packed_store import PackedWriter, PackedReader, is_packed
+from src.learning.training.sampling import steer_sampling, gear_sampling
+from src.learning.training.training_file_reader import TrainingFileReader
+from src.utilities.telemetry_store import has_telemetry, convert_csv
+from src.utilities.transformer import Transformer
+from notebooks.notebook_commons import read_shifted_numerics_and_targets
+
+
+class PreparationJob:
+    def __init__(self, lap_index, filename, laps_path, part_path, memory_variants, frame_config, augmentation, seed):
+        self.lap_index = lap_index
+        self.filename = filename
+        self.laps_path = laps_path
+        self.part_path = part_path
+        self.memory_variants = memory_variants
+        self.frame_config = frame_config
+        self.augmentation = augmentation
+        self.seed = seed
+
+
+class FrameConfig:
+    """The part of the configuration Transformer needs, small enough to send to worker processes."""
+    def __init__(self, config):
+        self.frame_width = config.frame_width
+        self.frame_height = config.frame_height
+        self.frame_dtype = config.frame_dtype
+
+
+def memory_string(memory):
+    return 'n{}_m{}'.format(*memory)
+
+
+def prepare_lap(job):
+    """Streams one lap once and writes a part store per memory variant, returns the sample count per variant."""
+    np.random.seed(job.seed + job.lap_index)
+    reader = TrainingFileReader(path_to_training=job.laps_path)
+    collector = Collector()
+
+    numerics, diffs = read_shifted_numerics_and_targets(reader, job.filename, collector.numeric_columns(), collector.numeric_columns())
+
+    augmenter = None
+    if job.augmentation:
+        from tensorflow.keras.preprocessing.image import ImageDataGenerator
+        augmenter = ImageDataGenerator()
+
+    variants = []
+    for memory in job.memory_variants:
+        transformer = Transformer(job.frame_config, memory)
+        writer = PackedWriter(job.part_path, memory_string(memory), capacity=max(diffs.shape[0], 1))
+        variants.append((transformer, transformer.create_memory_stack(), transformer.create_memory_stack(), writer))
+
+    for offset, chunk in reader.read_video_chunks(job.filename + '.avi', chunk_size=256, stop=diffs.shape[0]):
+        for i, frame in enumerate(chunk, offset):
+            if augmenter is not None:
+                frame = augmenter.apply_transform(frame, {'brightness': np.random.uniform(0.4, 1.3)})
+
+            for transformer, mem_slice_frames, mem_slice_numerics, writer in variants:
+                mem_frame = transformer.session_frame_wide(frame, mem_slice_frames)
+                mem_numeric = transformer.session_numeric_np(numerics[i], mem_slice_numerics)
+
+                if mem_frame is None or mem_numeric is None:
+                    continue
+
+                writer.append(mem_frame, mem_numeric, diffs[i])
+
+    counts = {}
+    for memory, (_, _, _, writer) in zip(job.memory_variants, variants):
+        writer.close()
+        counts[memory_string(memory)] = writer.count
+
+    return job.lap_index, counts
+
+
+def clean_folder(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    for old_file in glob.glob(path + '*'):
+        if os.path.isfile(old_file):
+            os.remove(old_file)
+
+
+def merge_parts(part_paths, path, mem_string, chunk_size=1024):
+    """Concatenates per-lap part stores in lap order into the final packed store, returns all stored diffs."""
+    readers = [PackedReader(part_path, mem_string) for part_path in part_paths if is_packed(part_path, mem_string)]
+    total = sum(len(reader) for reader in readers)
+    if total == 0:
+        # without a header the generator would silently fall back to the per-sample files of an older preparation
+        raise ValueError('No samples for memory {}, every lap is shorter than the memory window!'.format(mem_string))
+
+    writer = PackedWriter(path, mem_string, capacity=total)
+    for reader in readers:
+        for start in range(0, len(reader), chunk_size):
+            end = start + chunk_size
+            writer.append_batch(reader.frames[start:end], reader.numerics[start:end], reader.diffs[start:end])
+    writer.close()
+
+    return np.concatenate([np.asarray(reader.diffs) for reader in readers], axis=0)
+
+
+def prepare(config, base_path, memory_variants, laps_folder='laps/', validation=False, augmentation=False, workers=None, seed=0,
+            convert_telemetry=False):
+    laps_path = base_path + laps_folder
+    filenames = sorted(fn.split('.')[0] for fn in os.listdir(laps_path) if fn.endswith('.avi') and (not validation or 'validation' in fn))
+    if len(filenames) == 0:
+        logging.info("No laps found in {}".format(laps_path))
+        return
+
+    if convert_telemetry:
+        for filename in filenames:
+            if not has_telemetry(laps_path + filename):
+                logging.info("Converted {} telemetry rows of {}".format(convert_csv(laps_path + filename), filename))
+
+    suffix = '_val/' if validation else '/'
+    parts_root = base_path + 'preparation_parts' + suffix
+    shutil.rmtree(parts_root, ignore_errors=True)
+
+    jobs = []
+    for lap_index, filename in enumerate(filenames):
+        part_path = '{}{:04d}/'.format(parts_root, lap_index)
+        os.makedirs(part_path)
+        jobs.append(PreparationJob(lap_index, filename, laps_path, part_path, memory_variants, FrameConfig(config),
+                                   augmentation and not validation, seed))
+
+    start_time = time.time()
+    logging.info("Preparing {} laps for {} memory variants".format(len(jobs), len(memory_variants)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(prepare_lap, job): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            lap_index, counts = future.result()
+            logging.info("[{}/{}] {} done in {:.0f}s: {}".format(done, len(jobs), job.filename, time.time() - start_time, counts))
+
+    part_paths = [job.part_path for job in jobs]
+    for memory in memory_variants:
+        mem_string = memory_string(memory)
+        path = base_path + mem_string + suffix
+        clean_folder(path)
+
+        total_diff = merge_parts(part_paths, path, mem_string)
+        if not validation:
+            np.save(path + GenFiles.steer_sampling.format(mem_string), steer_sampling(total_diff))
+            np.save(path + GenFiles.gear_sampling.format(mem_string), gear_sampling(total_diff))
+
+        logging.info("Wrote {} {} samples to {}".format(total_diff.shape[0], mem_string, path))
+
+    shutil.rmtree(parts_root, ignore_errors=True)
+    logging.info("Preparation done in {:.0f}s".format(time.time() - start_time))
+
+
+def parse_memory(value):
+    length, interval = value.split(',')
+    return int(length), int(interval)
+
+
+if __name__ == "__main__":
+    from commons.configuration_manager import ConfigurationManager
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    parser = argparse.ArgumentParser(description='Headless parallel preparation of packed memory variant datasets from recorded laps.')
+    parser.add_argument('--base-path', default='../../training/')
+    parser.add_argument('--memory', type=parse_memory, nargs='+', default=[(1, 1)], help='length,interval pairs, e.g. 1,1 4,2')
+    parser.add_argument('--validation', action='store_true', help='read validation_laps/ and write n*_m*_val stores')
+    parser.add_argument('--augmentation', action='store_true', help='random brightness on training laps')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--convert-telemetry', action='store_true', help='store columnar telemetry next to laps that only have a CSV')
+    args = parser.parse_args()
+
+    prepare(ConfigurationManager().config, args.base_path, args.memory,
+            laps_folder='validation_laps/' if args.validation else 'laps/',
+            validation=args.validation, augmentation=args.augmentation, workers=args.workers, seed=args.seed,
+            convert_telemetry=args.convert_telemetry)
@@ -0,0 +1,149 @@
+import os
+import glob
+import numpy as np
+
+
+def half_max_thresh(counts: dict):
+    return int(np.mean(counts) + (np.max(counts) - np.mean(counts)) // 2)
+
+
+def mean_thresh(counts: dict):
+    return int(np.mean(counts))
+
+
+def double_mean_thresh(counts: dict):
+    return int(2 * np.mean(counts))
+
+
+def downsample_indexes(data_column, sample_threshold, sampling=None, bin_start=-1.0, bin_end=1.0, bin_size=0.01):
+    if sampling is None:
+        downsampling = np.ones(data_column.shape, dtype=int)
+    else:
+        downsampling = np.copy(sampling)
+
+    bins = np.arange(bin_start, bin_end, bin_size)
+    indices = np.digitize(data_column, bins)
+    unique_bins, counts = np.unique(indices, return_counts=True)
+    sorted_counts = np.sort(counts)
+
+    count_dict = dict(zip(unique_bins, counts))
+    threshold_count = sample_threshold(counts)
+
+    for unique_bin, count in count_dict.items():
+        if count > threshold_count:
+            indexes = np.where(indices == unique_bin)[0]
+            to_del_indexes = np.random.choice(indexes, count - threshold_count, replace=False)
+
+            downsampling[to_del_indexes] = 0
+
+    return downsampling
+
+
+def upsample_indexes(data_column, sampling, sample_threshold, bin_start=-1.0, bin_end=1.0, bin_size=0.01):
+    upsample_multipliers = np.zeros(data_column.shape, dtype=int)
+    bins = np.arange(bin_start, bin_end, bin_size)
+    indices = np.digitize(data_column, bins)
+
+    unique_bins, counts = np.unique(indices, return_counts=True)
+    count_dict = dict(zip(unique_bins, counts))
+    threshold_count = sample_threshold(counts)
+
+    for i in range(0, upsample_multipliers.shape[0]):
+        count = count_dict[indices[i]]
+        if count >= threshold_count:
+            upsample_multipliers[i] = sampling[i]
+        else:
+            upsample_multipliers[i] = int(threshold_count / count)
+
+    return upsample_multipliers
+
+
+# At current recording speed, 50 instances _should_ come up to about 5 seconds
+def sample_recovery_indexes(gear_column, sampling=None, count_to_crash=20, peek_limit=100):
+    if sampling is None:
+        recovery_sampling = np.ones(gear_column.shape, dtype=int)
+    else:
+        recovery_sampling = np.copy(sampling)
+    last_gear = None
+
+    recovery_start = None
+    recovery_end = None
+
+    for index, current_gear in enumerate(gear_column):
+        if last_gear is None:
+            last_gear = current_gear
+            continue
+
+        if last_gear == 1 and current_gear == 0 and is_reversing_ahead(gear_column, index, peek_limit):
+            recovery_start = index
+
+        if last_gear == 0 and current_gear == 1 and is_reversing_before(gear_column, index, peek_limit):
+            recovery_end = index
+
+        if recovery_start is not None and recovery_end is not None:
+            recovery_sampling[recovery_start:recovery_end] = 1
+
+            bad_driving_start = recovery_start - count_to_crash
+            if bad_driving_start >= 0:
+                recovery_sampling[bad_driving_start : recovery_start] = 0
+            else:
+                recovery_sampling[0 : recovery_start] = 0
+
+            recovery_start = None
+            recovery_end = None
+
+        last_gear = current_gear
+    return recovery_sampling
+
+
+def is_reversing_ahead(gear_column, index, peek_limit):
+    end_index = index + peek_limit
+
+    if end_index >= gear_column.shape[0]:
+        end_index = gear_column.shape[0] - 1
+
+    for i in range(index, end_index):
+        if gear_column[i] == -1:
+            return True
+
+    return False
+
+
+def is_reversing_before(gear_column, index, peek_limit):
+    start_index = index - peek_limit
+
+    if start_index < 0:
+        start_index = 0
+
+    for i in range(index, start_index, -1):
+        if gear_column[i] == -1:
+            return True
+
+    return False
+
+
+def store_sampling(new_sampling, path, filename, clean=False):
+    if os.path.isfile(path + filename):
+        if clean:
+            os.remove(glob.glob(path + filename)[0])
+            full_sampling = new_sampling
+        else:
+            stored_sampling = np.load(path + filename, allow_pickle=True)
+            full_sampling = np.concatenate((stored_sampling, new_sampling), axis=0)
+    else:
+        full_sampling = new_sampling
+
+    np.save(path + filename, full_sampling)
+
+
+def steer_sampling(total_diff):
+    """Shifted steering + throttle sampling used by the preparator: recovery sampling, then steering upsampling."""
+    sampling = np.ones(total_diff.shape[0])
+    sampling = sample_recovery_indexes(total_diff[:, 0], sampling=sampling)
+    return upsample_indexes(total_diff[:, 1], sampling, mean_thresh)
+
+
+def gear_sampling(total_diff):
+    """Shifted gear sampling used by the preparator: gear classes down- and upsampled to their mean count."""
+    sampling = downsample_indexes(total_diff[:, 0], mean_thresh, bin_start=-1, bin_end=2, bin_size=1)
+    return upsample_indexes(total_diff[:, 0], sampling, mean_thresh, bin_start=-1, bin_end=2, bin_size=1)
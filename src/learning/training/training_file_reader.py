@@ -4,6 +4,11 @@ import numpy as np
 import json
 from collections import namedtuple
 
+from src.utilities.telemetry_store import has_telemetry, load_telemetry, select_columns
+
+
+VideoInfo = namedtuple('VideoInfo', ['frame_count', 'fps', 'width', 'height'])
+
 
 def get_namedtuple_from_json_string(line):
     return json.loads(line, object_hook=lambda d: namedtuple('stuff', d.keys())(*d.values()))
@@ -13,41 +18,103 @@ class TrainingFileReader:
     def __init__(self, path_to_training="../training/"):
         self.path_to_training = path_to_training
 
-    def read_video(self, filename):
+    def video_info(self, filename):
+        """Frame count, fps and resolution from the container header, nothing is decoded."""
         cap = cv2.VideoCapture(self.path_to_training + filename)
-        frames = []
+        try:
+            return VideoInfo(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS),
+                             int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        finally:
+            cap.release()
 
-        while True:
-            result, frame = cap.read()
+    def frame_count(self, filename):
+        return self.video_info(filename).frame_count
 
-            if cv2.waitKey(1) & 0xFF == ord('q') or not result:
-                break
-
-            frames.append(frame)
-
-        cap.release()
-        return np.array(frames)
+    def read_video(self, filename):
+        return np.array(list(self.iter_video(filename)))
+
+    def iter_video(self, filename, start=0, stop=None):
+        """Headless frame iterator over [start, stop), frames are decoded one at a time and never collected."""
+        cap = self.__open_at(filename, start)
+        try:
+            i = start
+            while stop is None or i < stop:
+                result, frame = cap.read()
+                if not result:
+                    break
+                yield frame
+                i += 1
+        finally:
+            cap.release()
+
+    def read_video_chunks(self, filename, chunk_size=256, start=0, stop=None, out=None):
+        """
+        Yields (offset, frames) with up to chunk_size frames of [start, stop) decoded into one preallocated uint8 array.
+        The array is reused, a chunk is only valid until the next one is requested.
+        """
+        cap = self.__open_at(filename, start)
+        try:
+            offset = start
+            filled = 0
+            while stop is None or offset + filled < stop:
+                if out is not None:
+                    result, _ = cap.read(out[filled])
+                else:
+                    result, frame = cap.read()
+                    if result:
+                        out = np.empty((chunk_size, *frame.shape), dtype=np.uint8)
+                        out[0] = frame
+                if not result:
+                    break
+
+                filled += 1
+                if filled == out.shape[0]:
+                    yield offset, out
+                    offset += filled
+                    filled = 0
+
+            if filled > 0:
+                yield offset, out[:filled]
+        finally:
+            cap.release()
+
+    def read_video_time_range(self, filename, start_seconds, end_seconds=None, chunk_size=256):
+        fps = self.video_info(filename).fps
+        start = int(round(start_seconds * fps))
+        stop = None if end_seconds is None else int(round(end_seconds * fps))
+        return self.read_video_chunks(filename, chunk_size=chunk_size, start=start, stop=stop)
 
     def read_video_gen(self, filename, yield_count):
-        cap = cv2.VideoCapture(self.path_to_training + filename)
-        i = 0
-
-        while True:
-            result, frame = cap.read()
-
-            if cv2.waitKey(1) & 0xFF == ord('q') or not result:
-                break
-
+        for i, frame in enumerate(self.iter_video(filename, stop=yield_count)):
             yield i, frame
 
-            i += 1
-            if i + 1 > yield_count:
-                break
-
-        cap.release()
+    def __open_at(self, filename, start):
+        cap = cv2.VideoCapture(self.path_to_training + filename)
+        if start > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+            if int(cap.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+                # inexact seeking in this container, step through the frames without decoding them
+                cap.release()
+                cap = cv2.VideoCapture(self.path_to_training + filename)
+                for _ in range(start):
+                    if not cap.grab():
+                        break
+        return cap
 
     def read_telemetry_as_csv(self, filename):
         return pd.read_csv(self.path_to_training + filename)
 
     def read_specific_telemetry_columns(self, filename, columns):
         return pd.read_csv(self.path_to_training + filename, usecols=columns)[columns]
+
+    def read_telemetry_column_sets(self, session_name, *column_sets):
+        """
+        One float64 array per column set from a single read of the session telemetry.
+        The columnar .npy is memory-mapped when present, older sessions fall back to parsing their CSV once.
+        """
+        if has_telemetry(self.path_to_training + session_name):
+            return select_columns(load_telemetry(self.path_to_training + session_name), *column_sets)
+
+        all_columns = list(dict.fromkeys(column for columns in column_sets for column in columns))
+        df = pd.read_csv(self.path_to_training + session_name + '.csv', usecols=all_columns)
+        return [df[list(columns)].to_numpy(dtype=np.float64) for columns in column_sets]
@@ -6,22 +6,27 @@ import logging
 import traceback
 import asyncio
 import signal
+import functools
 import numpy as np
 import zmq
 from zmq.asyncio import Context
 
-from commons.common_zmq import recv_array_with_json, initialize_subscriber, initialize_publisher
+from commons.common_zmq import initialize_subscriber, initialize_publisher
 from commons.configuration_manager import ConfigurationManager
 
 from src.learning.model_wrapper import ModelWrapper
+from src.learning.dagger_trainer import DaggerTrainer
 from src.learning.training.generator import Generator
-from utilities.transformer import Transformer
+from src.learning.training.prefetcher import BatchPrefetcher
+from src.utilities.latency import LatencyMonitor
+from src.utilities.frame_transport import wait_for_message, recv_frame_message, recv_latest_frames
+from src.utilities.transformer import Transformer
 from src.utilities.recorder import Recorder
 
 
-async def main_dagger(context: Context):
-    config_manager = ConfigurationManager()
-    conf = config_manager.config
+async def main_dagger(context: Context, conf=None):
+    if conf is None:
+        conf = ConfigurationManager().config
     transformer = Transformer(conf)
     recorder = Recorder(conf, transformer)
 
@@ -31,62 +36,107 @@ async def main_dagger(context: Context):
     control_mode = conf.control_mode
     dagger_training_enabled = conf.dagger_training_enabled
     dagger_epoch_size = conf.dagger_epoch_size
+    ingestion_mode = conf.ingestion_mode
+    skipped_frame_response = conf.skipped_frame_response
+    trainer = None
+    monitor = LatencyMonitor('control_loop', export_interval=conf.latency_export_interval, export_path=conf.latency_export_path)
 
     try:
         model = ModelWrapper(conf, output_shape=2)
-        mem_slice_frames = []
-        mem_slice_numerics = []
+        if dagger_training_enabled and not model.trainable:
+            raise ValueError('Misconfigured DAgger training, {} is inference only!'.format(conf.model_name))
+        trainer = DaggerTrainer(recorder, functools.partial(fit_and_eval_model, model, conf, recorder.dagger_index, {}))
+        mem_slice_frames = transformer.create_memory_stack()
+        mem_slice_numerics = transformer.create_memory_stack()
         data_count = 0
         dagger_iteration = 0
+        dagger_finished = False
+        last_controls = None
+
+        if ingestion_mode not in ('ordered', 'latest') or skipped_frame_response not in ('expert', 'previous'):
+            raise ValueError('Misconfigured ingestion mode!')
 
         await initialize_subscriber(data_queue, conf.data_queue_port)
         await initialize_publisher(controls_queue, conf.controls_queue_port)
 
         while True:
-            frame, data = await recv_array_with_json(queue=data_queue)
+            monitor.maybe_export()
+            # idle time until the next frame is a stage of its own, receive only covers taking the message in
+            waiting = monitor.now()
+            await wait_for_message(data_queue)
+            tick = monitor.lap('wait', waiting)
+            if ingestion_mode == 'latest':
+                # only the newest frame is acted on, so control latency stays at one inference however long the backlog
+                messages = await recv_latest_frames(data_queue)
+                stage = monitor.lap('receive', tick)
+
+                for skipped_frame, (skipped_telemetry, skipped_expert_action) in messages[:-1]:
+                    if skipped_telemetry is None or skipped_expert_action is None:
+                        monitor.count('none_messages')
+                        continue
+
+                    # skipped frames still go through the memory, so memory intervals keep counting frames
+                    transformer.session_frame_wide(skipped_frame, mem_slice_frames)
+                    transformer.session_numeric_input(skipped_telemetry, mem_slice_numerics)
+
+                    fallback = skipped_expert_action if skipped_frame_response == 'expert' or last_controls is None else last_controls
+                    recorder.record_full(skipped_frame, skipped_telemetry, skipped_expert_action, fallback)
+                    controls_queue.send_json(fallback)
+                    monitor.count('skipped_frames')
+
+                frame, data = messages[-1]
+                received = stage = monitor.lap('skipped', stage)
+            else:
+                frame, data = await recv_frame_message(data_queue)
+                received = stage = monitor.lap('receive', tick)
             # TODO handle case if expert data is not available, i.e full model control
             telemetry, expert_action = data
             if frame is None or telemetry is None or expert_action is None:
                 logging.info("None data")
+                monitor.count('none_messages')
                 continue
 
             #recorder.record_with_expert(frame, telemetry, expert_action)
             mem_frame = transformer.session_frame_wide(frame, mem_slice_frames)
+            stage = monitor.lap('frame', stage)
             mem_telemetry = transformer.session_numeric_input(telemetry, mem_slice_numerics)
             mem_expert_action = transformer.session_expert_action(expert_action)
+            stage = monitor.lap('numeric', stage)
             if mem_frame is None or mem_telemetry is None:
                 # Send back these first few instances, as the other application expects 1:1 responses
                 controls_queue.send_json(expert_action)
+                monitor.count('warmup_responses')
                 continue
 
             data_count += recorder.record_session(mem_frame, mem_telemetry, mem_expert_action)
             if control_mode == 'shared' and dagger_training_enabled and data_count % dagger_epoch_size == 0:
-                recorder.store_session_batch(dagger_epoch_size)
-
-                if dagger_iteration < conf.dagger_epochs_count:
-                    # send 0 throttle so the car won't go wild during fitting
-                    null_controls = expert_action.copy()
-                    null_controls['d_throttle'] = 0.0
-                    controls_queue.send_json(null_controls)
-
-                    await fit_and_eval_model(model, conf)
-                    dagger_iteration += 1
-                    logging.info('Dagger iter {}'.format(dagger_iteration))
-                    continue
+                # training runs in the background, the model keeps driving on its current weights meanwhile
+                session_batch = recorder.take_session_batch(dagger_epoch_size)
+
+                if trainer.requested < conf.dagger_epochs_count:
+                    if not trainer.request(session_batch):
+                        logging.info("Dagger fit already queued, batch added to it")
                 else:
-                    dagger_iteration = 50
+                    trainer.store(session_batch)
+                    dagger_finished = True
+
+            dagger_iteration = 50 if dagger_finished and not trainer.busy else trainer.completed
+            stage = monitor.lap('record_session', stage)
             try:
                 if control_mode == 'full_expert' or expert_action['manual_override']:
                     next_controls = expert_action.copy()
-                    time.sleep(0.035)
+                    time.sleep(conf.full_expert_delay)
+                    stage = monitor.lap('expert_delay', stage)
                 elif control_mode == 'full_model':
                     next_controls = model.predict(mem_frame, mem_telemetry).to_dict()
+                    stage = monitor.lap('predict', stage)
                     next_controls['d_gear'] = mem_expert_action[0]
                     #next_controls['d_throttle'] = mem_expert_action[2]
                 elif control_mode == 'shared':
                     expert_probability = np.exp(-0.02 * dagger_iteration)
                     model_probability = np.random.random()
                     model_action = model.predict(mem_frame, mem_telemetry).to_dict()
+                    stage = monitor.lap('predict', stage)
 
                     if expert_probability > model_probability:
                         next_controls = model_action
@@ -99,9 +149,15 @@ async def main_dagger(context: Context):
                 else:
                     raise ValueError('Misconfigured control mode!')
 
-                recorder.record_full(frame, telemetry, expert_action, next_controls)
+                if recorder.record_full(frame, telemetry, expert_action, next_controls) == 0:
+                    monitor.count('recording_dropped')
+                stage = monitor.lap('record_full', stage)
                 controls_queue.send_json(next_controls)
+                last_controls = next_controls
+                monitor.lap('tick', received)
+                monitor.lap('send', stage)
             except Exception as ex:
+                monitor.count('predict_errors')
                 print("Predicting exception: {}".format(ex))
                 traceback.print_tb(ex.__traceback__)
     except Exception as ex:
@@ -111,6 +167,11 @@ async def main_dagger(context: Context):
         data_queue.close()
         controls_queue.close()
 
+        monitor.export()
+
+        if trainer is not None:
+            trainer.shutdown()
+
         files = glob.glob(conf.path_to_session_files + '*')
         for f in files:
             os.remove(f)
@@ -123,15 +184,39 @@ async def main_dagger(context: Context):
         model.save_best_model()
 
 
-async def fit_and_eval_model(model, conf):
+def fit_and_eval_model(model, conf, dagger_index=None, generators=None):
+    """generators keeps the train and eval generators between calls, the train one is refreshed with the index split."""
     logging.info("Fitting with generator")
+    generators = {} if generators is None else generators
     try:
-        generator = Generator(conf, batch_size=32, column_mode='steer')
-        model.fit(generator, generator.generate, epochs=8, verbose=0, fresh_model=False)
+        split = dagger_index.split() if dagger_index is not None else None
+        generator = generators.get('train')
+        if generator is None:
+            generator = generators['train'] = Generator(conf, batch_size=32, column_mode='steer', frame_dtype=model.frame_dtype,
+                                                        split_override=split)
+        else:
+            generator.refresh(split_override=split)
+
+        if conf.generator_backend == 'prefetch':
+            loader = BatchPrefetcher(generator, workers=conf.loader_workers, queue_depth=conf.loader_queue_depth)
+            model.fit(loader, loader.generate, epochs=8, verbose=0, fresh_model=False)
+            logging.info("Loader stats: {}".format(loader.stats.summary()))
+        elif conf.generator_backend == 'tf_data':
+            cache = None if conf.dataset_cache == 'none' else conf.dataset_cache
+            model.fit(generator, functools.partial(generator.dataset, cache=cache), epochs=8, verbose=0, fresh_model=False)
+        elif conf.generator_backend == 'python':
+            model.fit(generator, generator.generate, epochs=8, verbose=0, fresh_model=False)
+        else:
+            raise ValueError('Misconfigured generator backend!')
 
         logging.info("Model evaluation")
-        eval_generator = Generator(conf, eval_mode=True, batch_size=32, column_mode='steer')
+        # the validation set does not change during a session, neither does its split
+        eval_generator = generators.get('eval')
+        if eval_generator is None:
+            eval_generator = generators['eval'] = Generator(conf, eval_mode=True, batch_size=32, column_mode='steer',
+                                                            frame_dtype=model.frame_dtype)
         model.evaluate_model(eval_generator)
+        logging.info("Evaluation MSE per output (steering, throttle): {}".format(model.output_errors))
 
         logging.info("Best DAgger MSE: {}".format(model.min_error))
         logging.info("Fitting done")
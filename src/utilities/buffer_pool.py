@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+
+
+class BufferPool:
+    """
+    Thread-safe free lists of preallocated arrays keyed by shape and dtype.
+    Lets one thread hand filled arrays to another and get them back once consumed, instead of allocating new ones.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__free = {}
+
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype))
+        with self.__lock:
+            free = self.__free.get(key)
+            if free:
+                self.reused += 1
+                return free.pop()
+            self.allocated += 1
+
+        return np.empty(key[0], dtype=key[1])
+
+    def release(self, array):
+        """Returns an array to the pool, views are released through the array they were taken from."""
+        while array.base is not None and isinstance(array.base, np.ndarray):
+            array = array.base
+
+        with self.__lock:
+            self.__free.setdefault((array.shape, array.dtype), []).append(array)
+
+
+class SessionBuffer:
+    """
+    Row-by-row session recording into pooled frame, numeric and diff arrays.
+    Full batches are detached as views, the store side releases them back to the pool when written.
+    """
+    def __init__(self, capacity, pool=None):
+        self.capacity = capacity
+        self.pool = pool if pool is not None else BufferPool()
+        self.count = 0
+
+        self.__arrays = None
+
+    def __acquire(self, capacity, rows):
+        return [self.pool.acquire((capacity, *np.shape(row)), np.asarray(row).dtype) for row in rows]
+
+    def append(self, *rows):
+        if self.__arrays is None:
+            self.__arrays = self.__acquire(self.capacity, rows)
+        elif self.count == self.__arrays[0].shape[0]:
+            # nobody took a batch in time, keep everything in a larger set
+            grown = self.__acquire(2 * self.__arrays[0].shape[0], rows)
+            for new_array, array in zip(grown, self.__arrays):
+                new_array[:self.count] = array
+                self.pool.release(array)
+            self.__arrays = grown
+
+        for array, row in zip(self.__arrays, rows):
+            array[self.count] = row
+        self.count += 1
+
+    def take(self, batch_count):
+        """Detaches the oldest batch_count rows, the remaining ones continue in a fresh set of arrays."""
+        if self.__arrays is None:
+            return tuple(np.empty((0,)) for _ in range(3))
+
+        batch_count = min(batch_count, self.count)
+        arrays = self.__arrays
+        remaining = self.count - batch_count
+
+        self.__arrays = None
+        self.count = 0
+        if remaining > 0:
+            self.__arrays = [self.pool.acquire((max(self.capacity, remaining), *array.shape[1:]), array.dtype) for array in arrays]
+            for new_array, array in zip(self.__arrays, arrays):
+                new_array[:remaining] = array[batch_count:batch_count + remaining]
+            self.count = remaining
+
+        return tuple(array[:batch_count] for array in arrays)
+
+    def release(self, batch):
+        for array in batch:
+            if array.base is not None or array.shape[0] > 0:
+                self.pool.release(array)
+
+    def __len__(self):
+        return self.count
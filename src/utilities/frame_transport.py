@@ -0,0 +1,53 @@
+import json
+import numpy as np
+import zmq
+
+
+def parse_frame_message(parts):
+    """
+    Splits a [json metadata, frame buffer] multipart message, as sent by send_array_with_json, into (frame, data).
+    Parts received with copy=False are zmq.Frames, the frame is then a view of the ZMQ message buffer itself.
+    The buffer is kept alive by the view and returned to ZMQ once the memory stack and the recorder let go of it.
+    """
+    header, body = parts
+    if isinstance(header, zmq.Frame):
+        # json.loads takes the bytes as is, there is no intermediate str
+        header, body = header.bytes, body.buffer
+
+    metadata = json.loads(header)
+    frame = np.frombuffer(body, dtype=metadata['dtype']).reshape(metadata['shape'])
+    return frame, metadata['data']
+
+
+async def send_frame_message(queue, frame, data):
+    """Sends a frame and its data with the same framing as send_array_with_json, as a single multipart message."""
+    frame = np.ascontiguousarray(frame)
+    metadata = dict(dtype=str(frame.dtype), shape=frame.shape, data=data)
+    await queue.send_multipart([json.dumps(metadata).encode(), frame], copy=False)
+
+
+async def wait_for_message(queue):
+    """Returns once a message is queued on the socket, so idle waiting can be timed apart from receiving."""
+    await queue.poll(flags=zmq.POLLIN)
+
+
+async def recv_frame_message(queue, copy=False):
+    return parse_frame_message(await queue.recv_multipart(copy=copy))
+
+
+async def recv_latest_frames(queue, max_messages=1000, copy=False):
+    """
+    Waits for a message and then drains everything already queued on the socket without blocking.
+    Returns the messages oldest first, the caller acts on the last one and answers the rest with a fallback.
+    ZMQ_CONFLATE would drop the skipped messages instead, and it does not support multipart messages.
+    """
+    messages = [parse_frame_message(await queue.recv_multipart(copy=copy))]
+
+    while len(messages) < max_messages:
+        try:
+            parts = await queue.recv_multipart(flags=zmq.NOBLOCK, copy=copy)
+        except zmq.Again:
+            break
+        messages.append(parse_frame_message(parts))
+
+    return messages
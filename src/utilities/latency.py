@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import logging
+
+SUB_BUCKET_BITS = 2
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_BITS = 48
+
+
+class LatencyHistogram:
+    """
+    Log-bucketed nanosecond histogram, every power of two is split into SUB_BUCKETS linear buckets.
+    Recording is a bit_length and a shift, percentiles are accurate to about 1 / SUB_BUCKETS of the value.
+    """
+    def __init__(self):
+        self.counts = [0] * (MAX_BITS * SUB_BUCKETS)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, nanoseconds):
+        bits = nanoseconds.bit_length()
+        if bits <= SUB_BUCKET_BITS + 1:
+            index = nanoseconds
+        else:
+            index = (bits - SUB_BUCKET_BITS) * SUB_BUCKETS + ((nanoseconds >> (bits - SUB_BUCKET_BITS - 1)) & (SUB_BUCKETS - 1))
+        self.counts[min(index, len(self.counts) - 1)] += 1
+
+        self.count += 1
+        self.total += nanoseconds
+        if self.min is None or nanoseconds < self.min:
+            self.min = nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+
+    @staticmethod
+    def bucket_upper_bound(index):
+        if index < 2 * SUB_BUCKETS:
+            return index
+        bits = index // SUB_BUCKETS + SUB_BUCKET_BITS
+        step = 1 << (bits - SUB_BUCKET_BITS - 1)
+        return (1 << (bits - 1)) + (index % SUB_BUCKETS + 1) * step - 1
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0
+        rank = max(1, int(round(self.count * percent / 100.0)))
+
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_upper_bound(index), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Durations in microseconds."""
+        summary = {
+            'count': self.count,
+            'mean': self.total / self.count / 1000.0 if self.count > 0 else 0.0,
+            'min': (self.min or 0) / 1000.0,
+            'max': self.max / 1000.0
+        }
+        for percent in percentiles:
+            summary['p{}'.format(percent)] = self.percentile(percent) / 1000.0
+        return summary
+
+
+class LatencyMonitor:
+    """
+    Always-on per-stage timing of a loop, chained through lap() so every stage costs one perf_counter_ns call.
+    Summaries are logged and optionally written to a JSON file every export_interval seconds.
+
+        start = monitor.now()
+        ...
+        tick = monitor.lap('stage', start)
+    """
+    def __init__(self, name, export_interval=10.0, export_path=None):
+        self.name = name
+        self.export_interval = export_interval
+        self.export_path = export_path
+
+        self.stages = {}
+        self.counters = {}
+
+        self.__started = time.time()
+        self.__last_export = time.perf_counter()
+
+    @staticmethod
+    def now():
+        return time.perf_counter_ns()
+
+    def stage(self, name):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages[name] = LatencyHistogram()
+        return histogram
+
+    def lap(self, name, start):
+        """Records the time since start for the stage, returns the end time to start the next stage from."""
+        end = time.perf_counter_ns()
+        self.stage(name).record(end - start)
+        return end
+
+    def record(self, name, nanoseconds):
+        self.stage(name).record(nanoseconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        return {
+            'name': self.name,
+            'started': self.__started,
+            'time': time.time(),
+            'stages_us': {name: histogram.summary() for name, histogram in self.stages.items()},
+            'counters': dict(self.counters)
+        }
+
+    def maybe_export(self):
+        if self.export_interval is None or self.export_interval <= 0:
+            return False
+        if time.perf_counter() - self.__last_export < self.export_interval:
+            return False
+
+        self.export()
+        return True
+
+    def export(self):
+        self.__last_export = time.perf_counter()
+        snapshot = self.snapshot()
+
+        for name, summary in snapshot['stages_us'].items():
+            logging.info('{} {:<16} n={:<7} p50={:.1f}us p90={:.1f}us p99={:.1f}us max={:.1f}us'.format(
+                self.name, name, summary['count'], summary['p50'], summary['p90'], summary['p99'], summary['max']))
+        if len(self.counters) > 0:
+            logging.info('{} counters: {}'.format(self.name, self.counters))
+
+        if self.export_path is not None:
+            try:
+                with open(self.export_path + '.tmp', 'w') as metrics_file:
+                    json.dump(snapshot, metrics_file, indent=2)
+                os.replace(self.export_path + '.tmp', self.export_path)
+            except OSError as ex:
+                logging.warning("Could not write latency metrics: {}".format(ex))
+
+        return snapshot
@@ -1,6 +1,83 @@
 import numpy as np
 
 
+def memorize_sequence(instances, length, interval, out=None):
+    """
+    Vectorized memory_creator over a whole sequence, stacking along the last axis with the newest instance first.
+    Output has (length - 1) * interval fewer rows than the input and keeps its dtype.
+    """
+    len_diff = (length - 1) * interval
+    count = max(instances.shape[0] - len_diff, 0)
+    width = instances.shape[-1]
+
+    if out is None:
+        out = np.empty((count, *instances.shape[1:-1], width * length), dtype=instances.dtype)
+
+    for i in range(length):
+        start = len_diff - i * interval
+        out[..., i * width:(i + 1) * width] = instances[start:start + count]
+
+    return out
+
+
+class MemoryStack:
+    """
+    Fixed capacity circular buffer of the last (length - 1) * interval + 1 instances.
+    Stacked memory is written into a reused output buffer, newest instance first, along the last axis.
+    """
+    def __init__(self, length, interval):
+        self.length = length
+        self.interval = interval
+        self.capacity = (length - 1) * interval + 1
+        self.count = 0
+
+        self.__buffer = None
+        self.__output = None
+        self.__position = 0
+
+    def reserve(self, shape, dtype=np.float32):
+        """Returns the ring slot the next instance should be written into, call commit() after writing."""
+        if self.__buffer is None or self.__buffer.shape[1:] != tuple(shape) or self.__buffer.dtype != dtype:
+            self.__allocate(shape, dtype)
+
+        return self.__buffer[self.__position]
+
+    def commit(self):
+        self.__position = (self.__position + 1) % self.capacity
+        self.count += 1
+
+        return self.stacked()
+
+    def append(self, instance):
+        np.copyto(self.reserve(instance.shape, instance.dtype), instance)
+        return self.commit()
+
+    def stacked(self):
+        if self.count < self.capacity:
+            return None
+
+        width = self.__buffer.shape[-1]
+        newest = self.__position - 1
+        for i in range(self.length):
+            slot = (newest - i * self.interval) % self.capacity
+            self.__output[..., i * width:(i + 1) * width] = self.__buffer[slot]
+
+        return self.__output
+
+    def clear(self):
+        self.count = 0
+        self.__position = 0
+
+    def __allocate(self, shape, dtype):
+        shape = tuple(shape)
+        self.__buffer = np.zeros((self.capacity, *shape), dtype=dtype)
+        self.__output = np.zeros((*shape[:-1], shape[-1] * self.length), dtype=dtype)
+        self.clear()
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+
 class MemoryMaker:
     def __init__(self, config, memory_tuple=None):
         self.config = config
@@ -10,11 +87,18 @@ class MemoryMaker:
             self.memory_length = config.m_length
             self.memory_interval = config.m_interval
 
+    def create_stack(self):
+        return MemoryStack(self.memory_length, self.memory_interval)
+
     # axis=2 for frames, axis=0 for telems
     def memory_creator(self, instance, memory_list, axis=2):
         if instance is None:
             return None
 
+        if isinstance(memory_list, MemoryStack):
+            # stacks always concatenate along the last axis, which is axis=2 for frames and axis=0 for telems
+            return memory_list.append(instance)
+
         memory_list.append(instance)
         near_memory = memory_list[::-self.memory_interval]
 
@@ -30,3 +114,8 @@ class MemoryMaker:
         """(1,) for steering column. (1,2,) for steering and throttle etc."""
         reshaped = memorized.reshape((self.memory_length, 4))
         return np.concatenate(reshaped[:, columns], axis=0)
+
+    def columns_from_memorized_batch(self, memorized, columns=(1,)):
+        """Same as columns_from_memorized for a batch of memorized rows."""
+        reshaped = memorized.reshape((memorized.shape[0], self.memory_length, 4))
+        return reshaped[:, :, columns].reshape((memorized.shape[0], -1))
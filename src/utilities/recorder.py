@@ -1,11 +1,153 @@
 import os
+import csv
+import queue
 import logging
 import datetime
+import threading
 
 import numpy as np
 import pandas as pd
 import cv2
 from src.learning.training.generator import GenFiles
+from src.learning.training.packed_store import PackedWriter, is_packed, read_header
+from src.learning.training.dagger_index import DaggerIndex
+from src.utilities.telemetry_store import TelemetryWriter, numeric_columns_of, save_telemetry
+from src.utilities.buffer_pool import SessionBuffer
+
+
+class SessionStreamWriter:
+    """
+    Encodes video frames and appends telemetry rows on a background thread.
+    The control loop only enqueues, when the bounded queue is full the instance is dropped, counted and logged.
+    An instance that fails to be written is skipped, counted and logged the same way, the writer keeps going.
+    """
+    def __init__(self, storage_full_path, fps, resolution, queue_size=128, flush_interval=100, telemetry_format='csv', drop_log_interval=100):
+        self.storage_full_path = storage_full_path
+        self.fps = fps
+        self.resolution = resolution
+        self.flush_interval = flush_interval
+        self.drop_log_interval = drop_log_interval
+        self.write_csv = telemetry_format in ('csv', 'both')
+        self.write_npy = telemetry_format in ('npy', 'both')
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.__thread.start()
+
+    def write(self, frame, telemetry, expert_actions):
+        try:
+            self.__queue.put_nowait((frame, telemetry, expert_actions))
+            return 1
+        except queue.Full:
+            self.dropped += 1
+            # on the first drop and then every drop_log_interval drops, so a lossy recording is noticed while it happens
+            if self.dropped == 1 or self.dropped % self.drop_log_interval == 0:
+                logging.warning("Recording queue full, {} instances dropped so far.".format(self.dropped))
+            return 0
+
+    def __write_loop(self):
+        video = None
+        csv_file = None
+        csv_writer = None
+        telemetry_writer = None
+        telemetry_columns = None
+        expert_columns = None
+
+        try:
+            while True:
+                item = self.__queue.get()
+                if item is None:
+                    break
+                frame, telemetry, expert_actions = item
+
+                if video is None:
+                    video = cv2.VideoWriter(self.storage_full_path + ".avi", cv2.VideoWriter_fourcc(*'DIVX'), self.fps, self.resolution)
+                    telemetry_columns = list(telemetry.keys())
+                    expert_columns = list(expert_actions.keys())
+
+                    if self.write_csv:
+                        csv_file = open(self.storage_full_path + '.csv', 'w', newline='')
+                        csv_writer = csv.writer(csv_file, lineterminator='\n')
+                        # same layout as DataFrame.to_csv of telemetry and expert actions side by side
+                        csv_writer.writerow([''] + telemetry_columns + expert_columns)
+                    if self.write_npy:
+                        telemetry_writer = TelemetryWriter(self.storage_full_path, [numeric_columns_of(telemetry), numeric_columns_of(expert_actions)])
+
+                try:
+                    if csv_writer is not None:
+                        added_telemetry = [column for column in telemetry if column not in telemetry_columns]
+                        added_expert = [column for column in expert_actions if column not in expert_columns]
+                        if len(added_telemetry) > 0 or len(added_expert) > 0:
+                            csv_file, csv_writer = self.__add_csv_columns(csv_file, telemetry_columns, expert_columns, added_telemetry, added_expert)
+                            telemetry_columns += added_telemetry
+                            expert_columns += added_expert
+
+                    # everything that can fail on a malformed instance runs before the first write, the outputs stay aligned
+                    video_frame = frame.astype(np.uint8)
+                    if telemetry_writer is not None:
+                        telemetry_writer.append(telemetry, expert_actions)
+                    video.write(video_frame)
+                    if csv_writer is not None:
+                        csv_writer.writerow([self.written] +
+                                            [telemetry.get(column) for column in telemetry_columns] +
+                                            [expert_actions.get(column) for column in expert_columns])
+                    self.written += 1
+                except Exception as ex:
+                    self.failed += 1
+                    if self.failed == 1 or self.failed % self.drop_log_interval == 0:
+                        logging.error("Recording an instance failed, {} failed so far: {}".format(self.failed, ex))
+                    continue
+
+                if self.written % self.flush_interval == 0:
+                    if csv_file is not None:
+                        csv_file.flush()
+                    if telemetry_writer is not None:
+                        telemetry_writer.flush()
+        except Exception as ex:
+            logging.error("Recording writer failed: {}".format(ex))
+        finally:
+            if video is not None:
+                video.release()
+            if csv_file is not None:
+                csv_file.close()
+            if telemetry_writer is not None:
+                telemetry_writer.close()
+
+    def __add_csv_columns(self, csv_file, telemetry_columns, expert_columns, added_telemetry, added_expert):
+        """
+        Rewrites the CSV with columns that first appeared after its header, empty in the rows before,
+        the same columns DataFrame.to_csv writes for the whole session. Returns the reopened file and its writer.
+        """
+        csv_path = self.storage_full_path + '.csv'
+        csv_file.close()
+        with open(csv_path, 'r', newline='') as old_file, open(csv_path + '.tmp', 'w', newline='') as new_file:
+            new_writer = csv.writer(new_file, lineterminator='\n')
+            telemetry_end = 1 + len(telemetry_columns)
+            for line, row in enumerate(csv.reader(old_file)):
+                telemetry_fill, expert_fill = (added_telemetry, added_expert) if line == 0 else ([''] * len(added_telemetry), [''] * len(added_expert))
+                new_writer.writerow(row[:telemetry_end] + telemetry_fill + row[telemetry_end:] + expert_fill)
+        os.replace(csv_path + '.tmp', csv_path)
+
+        csv_file = open(csv_path, 'a', newline='')
+        return csv_file, csv.writer(csv_file, lineterminator='\n')
+
+    def close(self, timeout=5.0):
+        """Waits at most timeout seconds for queued instances to be written, returns whether everything was."""
+        try:
+            self.__queue.put(None, timeout=timeout)
+        except queue.Full:
+            logging.warning("Recording queue still full, {} instances not written.".format(self.__queue.qsize()))
+            return False
+
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            logging.warning("Recording writer did not finish in time, {} instances not written.".format(self.__queue.qsize()))
+            return False
+        return True
 
 
 class Recorder:
@@ -15,6 +157,20 @@ class Recorder:
         self.resolution = (config.recording_width, config.recording_height)
         self.fps = config.recording_fps
         self.memory = (config.m_length, config.m_interval)
+        self.session_storage = config.session_storage
+        self.telemetry_format = config.telemetry_format
+        self.__session_writer = None
+
+        if self.telemetry_format not in ('csv', 'npy', 'both'):
+            raise ValueError('Misconfigured telemetry format!')
+
+        if config.recording_mode == 'streaming':
+            self.__stream = SessionStreamWriter(self.storage_full_path, self.fps, self.resolution, queue_size=config.recording_queue_size,
+                                                telemetry_format=self.telemetry_format)
+        elif config.recording_mode == 'memory':
+            self.__stream = None
+        else:
+            raise ValueError('Misconfigured recording mode!')
 
         self.transformer = transformer
 
@@ -23,14 +179,29 @@ class Recorder:
         self.expert_actions = []
         self.predictions = []
 
-        self.session_frames = []
-        self.session_telemetry = []
-        self.session_expert_actions = []
+        # rows are copied into pooled arrays, batches go back to the pool once stored
+        self.session = SessionBuffer(config.dagger_epoch_size)
+
+        # the aggregate index replaces directory listings, it only has to catch up with a store left by an interrupted run
+        self.dagger_index = DaggerIndex(self.session_path, self.memory_string)
+        self.dagger_index.reconcile(self.__count_stored())
+
+    @property
+    def memory_string(self):
+        return 'n{}_m{}'.format(*self.memory)
+
+    def __count_stored(self):
+        if is_packed(self.session_path, self.memory_string):
+            return read_header(self.session_path, self.memory_string)['count']
+        if self.session_storage == 'genfiles' and os.path.isdir(self.session_path):
+            return len([fn for fn in os.listdir(self.session_path) if fn.startswith('frame_')])
+        return 0
 
     def __get_training_file_name(self, path_to_training):
         date = datetime.datetime.today().strftime("%Y_%m_%d")
-        files_from_same_date = list(filter(lambda file: date in file, os.listdir(path_to_training)))
-        return '{}{}_i{}'.format(path_to_training, date, str(int(len(files_from_same_date) / 2 + 1)))
+        # one video per session, the telemetry may be stored in one or two files next to it
+        files_from_same_date = list(filter(lambda file: date in file and file.endswith('.avi'), os.listdir(path_to_training)))
+        return '{}{}_i{}'.format(path_to_training, date, str(len(files_from_same_date) + 1))
 
     def record(self, frame, telemetry):
         if telemetry is not None and frame is not None:
@@ -48,6 +219,9 @@ class Recorder:
         return 0
 
     def record_full(self, frame, telemetry, expert_actions, predictions):
+        if self.__stream is not None and telemetry is not None and frame is not None and expert_actions is not None:
+            return self.__stream.write(frame, telemetry, expert_actions)
+
         if telemetry is not None and frame is not None and expert_actions is not None:
             self.frames.append(frame)
             self.telemetry.append(telemetry)
@@ -58,9 +232,8 @@ class Recorder:
 
     def record_session(self, mem_frame, mem_telemetry, expert_actions):
         if mem_telemetry is not None and mem_frame is not None and expert_actions is not None:
-            self.session_frames.append(mem_frame)
-            self.session_telemetry.append(mem_telemetry)
-            self.session_expert_actions.append(expert_actions)
+            # memory stacks and telemetry extractors reuse their output buffers, so the rows are copied
+            self.session.append(mem_frame, mem_telemetry, expert_actions)
             return 1
         return 0
 
@@ -68,21 +241,38 @@ class Recorder:
         return self.frames, self.telemetry, self.expert_actions
 
     def store_session_batch(self, batch_count):
-        stored_count = len(os.listdir(self.session_path)) // 3
-        memory_string = 'n{}_m{}'.format(*self.memory)
+        self.store_batch(self.take_session_batch(batch_count))
+
+    def take_session_batch(self, batch_count):
+        """Detaches the oldest batch_count session instances, so they can be stored off the control loop."""
+        return self.session.take(batch_count)
 
-        np_frames = np.array(self.session_frames[:batch_count])
-        np_numerics = np.array(self.session_telemetry[:batch_count])
-        np_diffs = np.array(self.session_expert_actions[:batch_count])
+    def store_batch(self, batch):
+        try:
+            self.__store_batch(*batch)
+        finally:
+            self.session.release(batch)
 
-        del self.session_frames[:batch_count]
-        del self.session_telemetry[:batch_count]
-        del self.session_expert_actions[:batch_count]
+    def __store_batch(self, np_frames, np_numerics, np_diffs):
+        memory_string = self.memory_string
+        batch_count = np_frames.shape[0]
 
-        for i in range(0, np_frames.shape[0]):
-            np.save(self.session_path + GenFiles.frame.format(memory_string, i + stored_count), np_frames[i])
-            np.save(self.session_path + GenFiles.numeric.format(memory_string, i + stored_count), np_numerics[i])
-            np.save(self.session_path + GenFiles.diff.format(memory_string, i + stored_count), np_diffs[i])
+        if self.session_storage == 'packed':
+            if self.__session_writer is None:
+                self.__session_writer = PackedWriter(self.session_path, memory_string, capacity=batch_count)
+            self.__session_writer.append_batch(np_frames, np_numerics, np_diffs)
+            self.__session_writer.flush()
+        elif self.session_storage == 'genfiles':
+            stored_count = self.dagger_index.count
+            for i in range(0, batch_count):
+                np.save(self.session_path + GenFiles.frame.format(memory_string, i + stored_count), np_frames[i])
+                np.save(self.session_path + GenFiles.numeric.format(memory_string, i + stored_count), np_numerics[i])
+                np.save(self.session_path + GenFiles.diff.format(memory_string, i + stored_count), np_diffs[i])
+        else:
+            raise ValueError('Misconfigured session storage!')
+
+        # registered once the samples are readable, a fit never sees indexes beyond the store
+        self.dagger_index.register(batch_count)
 
     def save_session_with_expert(self):
         session_length = len(self.telemetry)
@@ -103,14 +293,16 @@ class Recorder:
             out.write(self.frames[i].astype(np.uint8))
         out.release()
 
-        df_telem = pd.DataFrame(self.telemetry)
-        df_expert = pd.DataFrame(self.expert_actions)
-        df = pd.concat([df_telem, df_expert], axis=1)
-        df.to_csv(self.storage_full_path + '.csv')
+        self.__save_telemetry()
 
         logging.info("Telemetry, expert, and video saved successfully.")
 
     def save_session_with_predictions(self):
+        if self.__stream is not None:
+            finished = self.__stream.close()
+            logging.info("Streamed {} instances, dropped {}, finished: {}".format(self.__stream.written, self.__stream.dropped, finished))
+            return
+
         session_length = len(self.telemetry)
         assert session_length == len(self.frames) == len(self.expert_actions), "Stored actions are not of same length."
 
@@ -129,12 +321,18 @@ class Recorder:
             out.write(self.frames[i].astype(np.uint8))
         out.release()
 
-        df_telem = pd.DataFrame(self.telemetry)
-        df_expert = pd.DataFrame(self.expert_actions)
         # df_predictions = pd.DataFrame(self.predictions)
         # df_predictions = df_predictions[['p_steering', 'p_end']]
+        self.__save_telemetry()
+
+        logging.info("Telemetry, expert, and video saved successfully.")
 
-        df = pd.concat([df_telem, df_expert], axis=1)
-        df.to_csv(self.storage_full_path + '.csv')
+    def __save_telemetry(self):
+        if self.telemetry_format in ('npy', 'both'):
+            save_telemetry(self.storage_full_path, self.telemetry, self.expert_actions)
 
-        logging.info("Telemetry, expert, and video saved successfully.")
\ No newline at end of file
+        if self.telemetry_format in ('csv', 'both'):
+            df_telem = pd.DataFrame(self.telemetry)
+            df_expert = pd.DataFrame(self.expert_actions)
+            df = pd.concat([df_telem, df_expert], axis=1)
+            df.to_csv(self.storage_full_path + '.csv')
@@ -0,0 +1,121 @@
+import os
+import numbers
+import logging
+import numpy as np
+from numpy.lib import recfunctions
+
+from src.learning.training.collector import TelemetryExtractor
+
+
+class TelemetryFiles:
+    telemetry = '{}.npy'
+    raw = '{}.npy.raw'
+    csv = '{}.csv'
+
+
+def numeric_columns_of(message):
+    """Keys of a telemetry message that hold numbers, in message order."""
+    return [key for key, value in message.items() if isinstance(value, (numbers.Number, np.number)) or value is None]
+
+
+def unique_names(columns):
+    # same names pandas gives duplicated CSV headers on read
+    seen = {}
+    names = []
+    for column in columns:
+        if column in seen:
+            seen[column] += 1
+            names.append('{}.{}'.format(column, seen[column]))
+        else:
+            seen[column] = 0
+            names.append(column)
+    return names
+
+
+class TelemetryWriter:
+    """
+    Streams telemetry rows into a raw float64 file and converts it into a structured .npy keyed by column name on close.
+    Each appended message fills its own column group, missing values are stored as NaN.
+    """
+    def __init__(self, storage_full_path, column_groups):
+        self.storage_full_path = storage_full_path
+        self.columns = unique_names([column for group in column_groups for column in group])
+        self.count = 0
+
+        self.__extractors = [TelemetryExtractor(group, missing_value=np.nan) if len(group) > 0 else None for group in column_groups]
+        self.__raw_file = open(TelemetryFiles.raw.format(storage_full_path), 'wb')
+
+    def append(self, *messages):
+        # every group is extracted before any is written, a message that fails to convert leaves no partial row
+        rows = [extractor.extract(message) for extractor, message in zip(self.__extractors, messages) if extractor is not None]
+        for row in rows:
+            row.tofile(self.__raw_file)
+        self.count += 1
+
+    def flush(self):
+        self.__raw_file.flush()
+
+    def close(self):
+        if self.__raw_file is None:
+            return
+
+        self.__raw_file.close()
+        self.__raw_file = None
+
+        raw_path = TelemetryFiles.raw.format(self.storage_full_path)
+        raw = np.fromfile(raw_path, dtype=np.float64).reshape(self.count, len(self.columns))
+        np.save(TelemetryFiles.telemetry.format(self.storage_full_path), to_structured(raw, self.columns))
+        os.remove(raw_path)
+
+
+def to_structured(values, columns):
+    dtype = np.dtype([(column, np.float64) for column in columns])
+    return np.ascontiguousarray(values, dtype=np.float64).view(dtype).reshape(values.shape[0])
+
+
+def save_telemetry(storage_full_path, telemetry, expert_actions):
+    """Stores lists of telemetry and expert action messages side by side, like the CSV export."""
+    if len(telemetry) == 0:
+        return
+
+    writer = TelemetryWriter(storage_full_path, [numeric_columns_of(telemetry[0]), numeric_columns_of(expert_actions[0])])
+    for telemetry_message, expert_message in zip(telemetry, expert_actions):
+        writer.append(telemetry_message, expert_message)
+    writer.close()
+
+
+def has_telemetry(storage_full_path):
+    return os.path.isfile(TelemetryFiles.telemetry.format(storage_full_path))
+
+
+def load_telemetry(storage_full_path, mmap=True):
+    return np.load(TelemetryFiles.telemetry.format(storage_full_path), mmap_mode='r' if mmap else None)
+
+
+def select_columns(telemetry, *column_sets):
+    """One float64 array per column set, all taken from the same loaded table."""
+    return [recfunctions.structured_to_unstructured(telemetry[list(columns)], dtype=np.float64) for columns in column_sets]
+
+
+def convert_csv(storage_full_path, remove_csv=False):
+    """Converts a recorded telemetry CSV into the columnar format, returns the number of rows."""
+    import pandas as pd
+
+    df = pd.read_csv(TelemetryFiles.csv.format(storage_full_path), index_col=0, float_precision='round_trip')
+    numeric = df.select_dtypes(include=[np.number, np.bool_])
+    skipped = [column for column in df.columns if column not in numeric.columns]
+    if len(skipped) > 0:
+        logging.info("Not converting non-numeric columns {}".format(skipped))
+
+    np.save(TelemetryFiles.telemetry.format(storage_full_path), to_structured(numeric.to_numpy(dtype=np.float64), list(numeric.columns)))
+
+    if remove_csv:
+        os.remove(TelemetryFiles.csv.format(storage_full_path))
+    return numeric.shape[0]
+
+
+def export_csv(storage_full_path):
+    import pandas as pd
+
+    telemetry = load_telemetry(storage_full_path)
+    pd.DataFrame(telemetry).to_csv(TelemetryFiles.csv.format(storage_full_path))
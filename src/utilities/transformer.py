@@ -1,41 +1,81 @@
 import numpy as np
-import pandas as pd
 import cv2
 from PIL import Image
 
-from src.learning.training.collector import Collector
-from src.utilities.memory_maker import MemoryMaker
+from src.learning.training.collector import Collector, TelemetryExtractor
+from src.utilities.memory_maker import MemoryMaker, MemoryStack
+
+
+def crop_and_normalize(frames, height, out):
+    """
+    Crops the bottom height rows of a frame or a batch of frames straight into out.
+    Float outputs are scaled to [0, 1], uint8 outputs are kept as is and scaled inside the model.
+    """
+    cropped = frames[..., (frames.shape[-3] - height):, :, :]
+    if out.dtype == np.uint8:
+        np.copyto(out, cropped, casting='unsafe')
+        return out
+    return np.divide(cropped, 255, out=out, dtype=out.dtype)
+
+
+def convert_frames(frames, out):
+    """Converts between uint8 [0, 255] and float [0, 1] frames into out, copies when dtypes match."""
+    if frames.dtype == out.dtype:
+        np.copyto(out, frames)
+    elif out.dtype == np.uint8:
+        np.copyto(out, np.rint(np.clip(frames, 0.0, 1.0) * 255), casting='unsafe')
+    elif frames.dtype == np.uint8:
+        np.divide(frames, 255, out=out, dtype=out.dtype)
+    else:
+        np.copyto(out, frames, casting='unsafe')
+    return out
 
 
 class Transformer:
     def __init__(self, config, memory_tuple=None):
         self.resolution = (config.frame_width, config.frame_height)
+        self.frame_dtype = np.dtype(config.frame_dtype)
         self.__memory = MemoryMaker(config, memory_tuple)
         self.__labels = Collector()
+        self.__numeric_extractor = TelemetryExtractor(self.__labels.numeric_columns())
+        self.__diff_extractor = TelemetryExtractor(self.__labels.diff_columns())
+
+    def create_memory_stack(self):
+        return self.__memory.create_stack()
 
     def cut_wide_and_normalize_video_shifted(self, frames_list):
-        resized_frames = np.zeros((len(frames_list) - 1, self.resolution[1], self.resolution[0], 3), dtype=np.float32)
-        frame_height = frames_list[0].shape[0]
-        for i in range(0, resized_frames.shape[0]):
-            resized_frames[i] = frames_list[i][(frame_height - self.resolution[1]):, :, :].astype(np.float32)
-        resized_frames /= 255
-        return resized_frames
+        resized_frames = np.empty((len(frames_list) - 1, self.resolution[1], self.resolution[0], 3), dtype=self.frame_dtype)
+        return self.cut_wide_and_normalize_into(frames_list[:resized_frames.shape[0]], resized_frames)
+
+    def cut_wide_and_normalize_into(self, frames, out):
+        """Batched session_frame_wide preprocessing of an array or list of frames into a preallocated out."""
+        if isinstance(frames, np.ndarray):
+            crop_and_normalize(frames, self.resolution[1], out[:frames.shape[0]])
+        else:
+            for i, frame in enumerate(frames):
+                crop_and_normalize(frame, self.resolution[1], out[i])
+        return out
 
     def session_frame_wide(self, frame, memory_list):
         # test filming
         #resized = np.array(Image.fromarray(frame.astype(np.uint8)).resize(self.resolution), dtype=np.float32)
-        resized = frame[(frame.shape[0] - self.resolution[1]):, :, :].astype(np.float32)
-        resized /= 255
+        if isinstance(memory_list, MemoryStack):
+            # written straight into the ring slot, no intermediate float frame
+            slot = memory_list.reserve((self.resolution[1], *frame.shape[1:]), self.frame_dtype)
+            crop_and_normalize(frame, self.resolution[1], slot)
+            return memory_list.commit()
+
+        resized = np.empty((self.resolution[1], *frame.shape[1:]), dtype=self.frame_dtype)
+        crop_and_normalize(frame, self.resolution[1], resized)
         return self.__memory.memory_creator(resized, memory_list, axis=2)
 
     def session_numeric_input(self, telemetry, memory_list):
-        telemetry_df = pd.DataFrame.from_records([telemetry], columns=telemetry.keys())[telemetry.keys()]
-        telemetry_np = self.__labels.collect_df_columns(telemetry_df, self.__labels.numeric_columns()).to_numpy()[0]
+        telemetry_np = self.__numeric_extractor.extract(telemetry)
         return self.__memory.memory_creator(telemetry_np, memory_list, axis=0)
 
     def session_numeric_np(self, numeric, memory_list):
         return self.__memory.memory_creator(numeric, memory_list, axis=0)
 
     def session_expert_action(self, expert_action):
-        df = pd.DataFrame.from_records([expert_action], columns=expert_action.keys())[expert_action.keys()]
-        return self.__labels.collect_df_columns(df, self.__labels.diff_columns()).to_numpy()[0]
+        # reused vector, copy it to keep it past the next call
+        return self.__diff_extractor.extract(expert_action)